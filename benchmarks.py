@@ -0,0 +1,39 @@
+import numpy as np
+import time
+from PIL import Image
+from matplotlib import pyplot as plt
+from complex_dynamics import mandelbrot, power
+from image_creation import image, stack_cmaps
+
+# compares the matplotlib figure path of image_creation.image with the direct (array colorization + PNG) path
+
+def _timed(func, *args, **kwargs):
+
+    start_time = time.time()
+    func(*args, **kwargs)
+
+    return time.time() - start_time
+
+def colorization_benchmark(width=5, height=5, dpi=300, repeats=3):
+
+    lattice = mandelbrot((-2.2, 1.0), (-1.6, 1.6), power, args=2, width=width, height=height, dpi=dpi, maxiter=200)
+    image(lattice, direct=True, vert_exag=10.0, filename='benchmark_warmup')
+
+    for cmap, vert_exag in ((plt.cm.hot, 0.0), (plt.cm.hot, 10.0), (stack_cmaps(plt.cm.gist_earth, 5), 10.0)):
+
+        times = {}
+        for direct in (False, True):
+            name = 'benchmark_' + ('direct' if direct else 'figure')
+            times[direct] = min(_timed(image, lattice, cmap=cmap, gamma=0.3, vert_exag=vert_exag, filename=name, direct=direct) for r in range(repeats))
+            plt.close('all')
+
+        F = np.asarray(Image.open('benchmark_figure.png').convert('RGB'), dtype=np.int64)
+        D = np.asarray(Image.open('benchmark_direct.png').convert('RGB'), dtype=np.int64)
+        diff = np.abs(F - D)
+
+        print('%s vert_exag=%s: figure %ss, direct %ss (%sx), max/mean pixel difference %s/%s' % (cmap.name, vert_exag, np.round(times[False], 3),
+              np.round(times[True], 3), np.round(times[False]/times[True], 1), diff.max(), np.round(diff.mean(), 4)))
+
+if __name__ == '__main__':
+
+    colorization_benchmark()
@@ -1,137 +1,329 @@
 import numpy as np
-from numpy.random import random
+import os
+import json
+import hashlib
 import time
-from numba import jit
 from complex_dynamics import mandelbrot
-from image_creation import nebula_image, save_image_array
+from grid import viewport, pixel_index, precision_dtype
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from kernel_cache import kernel, specialize, get_num_threads, update_func_key
+from image_creation import image, nebula_image, save_image_array
 
-@jit
-def compute_cvals(Ncvals, xbound, ybound, update_func, args=2, width=5, height=5, dpi=100, importance_weight=0.75):
+ENERGY_CACHE_DIR = os.environ.get('FRACTAL_ENERGY_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'pythonfractals', 'energy'))
+
+_energy_cdfs = {}
+
+def _energy_cdf(xbound, ybound, update_func, args=2, width=5, height=5, dpi=100):
+
+    """
+        the cumulative distribution of the Mandelbrot escape times (the "energy grid"), used to importance sample c values,
+        the grid is cached in memory and on disk so that runs with the same bounds reuse it
+    """
+
+    xmin, xmax, ymin, ymax, nx, ny = viewport(xbound, ybound, width=width, height=height, dpi=dpi)
+    key = hashlib.sha1(repr((xmin, xmax, ymin, ymax, nx, ny, update_func_key(update_func), args)).encode()).hexdigest()
+
+    if key not in _energy_cdfs:
+
+        path = os.path.join(ENERGY_CACHE_DIR, key + '.npy')
+
+        if os.path.exists(path):
+            cdf = np.load(path)
+        else:
+            energy_grid = mandelbrot(xbound, ybound, update_func, args=args, width=width, height=height, dpi=dpi, maxiter=1000, horizon=2.5, log_smooth=False)[0]
+            cdf = np.cumsum(energy_grid.ravel())
+            cdf /= cdf[-1]
+            cdf[-1] = 1.0
+            try:
+                os.makedirs(ENERGY_CACHE_DIR, exist_ok=True)
+                np.save(path, cdf)
+            except OSError:
+                pass
+
+        _energy_cdfs[key] = cdf
+
+    return _energy_cdfs[key]
+
+def _sample_cvals(N, cdf, view, importance_weight, rng):
+
+    """
+        draws N c values, a fraction importance_weight from the cells of the energy grid (chosen by inverting its
+        cdf) and the rest uniformly, each point is jittered uniformly within its cell
+    """
+
+    xmin, xmax, ymin, ymax, nx, ny = view
+    NI = int(round(N * importance_weight))
+
+    cvals = np.empty(N, dtype=np.complex128)
+    x = rng.random(N)
+    y = rng.random(N)
+
+    if NI > 0:
+        cells = np.searchsorted(cdf, rng.random(NI), side='right')
+        x[:NI] += cells // ny
+        x[:NI] /= nx
+        y[:NI] += cells % ny
+        y[:NI] /= ny
+
+    cvals.real = xmin + x*(xmax - xmin)
+    cvals.imag = ymin + y*(ymax - ymin)
+
+    return cvals
+
+def compute_cvals(Ncvals, xbound, ybound, update_func, args=2, width=5, height=5, dpi=100, importance_weight=0.75, seed=None, chunk_size=None):
 
     """
         calculates the values to use for the Buddhabrot image, uses an "energy grid approach" where most of the sampled
         points (the fraction is determined by importance_weight) are on the boundary of the Mandelbrot set.
+        seed is an int or numpy Generator, returns a complex128 array or, if chunk_size is given, a generator of chunks
     """
-    xmin,xmax = [float(xbound[0]),float(xbound[1])]
-    ymin,ymax = [float(ybound[0]),float(ybound[1])]
 
-    nx = width*dpi
-    ny = height*dpi
+    if chunk_size is not None:
+        return cval_batches(Ncvals, xbound, ybound, update_func, args=args, width=width, height=height, dpi=dpi,
+                            importance_weight=importance_weight, batch_size=chunk_size, rng=np.random.default_rng(seed))
 
-    xvals  = np.array([xmin + i*(xmax-xmin)/(nx) for i in range(nx)], dtype=np.float32)
-    yvals  = np.array([ymin + i*(ymax-ymin)/(ny) for i in range(ny)], dtype=np.float32)
-    
-    xboxs = [(xvals[i],xvals[i+1]) for i in range(len(xvals)-1)]
-    yboxs = [(yvals[i],yvals[i+1]) for i in range(len(yvals)-1)]
-    xboxs = xboxs + [(xboxs[-1][1], xmax)]
-    yboxs = yboxs + [(yboxs[-1][1], ymax)]
+    view = viewport(xbound, ybound, width=width, height=height, dpi=dpi)
+    cdf = _energy_cdf(xbound, ybound, update_func, args=args, width=width, height=height, dpi=dpi) if importance_weight > 0.0 else None
 
-    NR = int(round(Ncvals * (1-importance_weight)))
-    cvals = []
+    return _sample_cvals(Ncvals, cdf, view, importance_weight, np.random.default_rng(seed))
 
-    for k in range(NR):
+def cval_batches(Ncvals, xbound, ybound, update_func, args=2, width=5, height=5, dpi=100, importance_weight=0.75, batch_size=100000, rng=None):
 
-        c = xmin+(random()*(xmax-xmin)) + 1j*(ymin+(random()*(ymax-ymin)))
-        cvals.append(c)
+    """
+        lazily yields batches of c values drawn like compute_cvals, so that the full cvals array is never materialized,
+        rng is a numpy Generator
+    """
 
-    if importance_weight > 0.0:
+    rng = np.random.default_rng() if rng is None else rng
+    view = viewport(xbound, ybound, width=width, height=height, dpi=dpi)
+    cdf = _energy_cdf(xbound, ybound, update_func, args=args, width=width, height=height, dpi=dpi) if importance_weight > 0.0 else None
 
-        NI = int(round(Ncvals * importance_weight))
-        energy_grid = mandelbrot(xbound, ybound, update_func, args=args, width=width, height=height, dpi=dpi, maxiter=1000, horizon=2.5, log_smooth=False)[0]
-        energy_grid = (energy_grid/energy_grid.sum()) * NI
+    for start in range(0, Ncvals, batch_size):
+        yield _sample_cvals(min(batch_size, Ncvals - start), cdf, view, importance_weight, rng)
 
-        for i in range(nx):
-            for j in range(ny):
-    
-                N = int(round(energy_grid[i,j]))
-        
-                xlo,xhi = xboxs[i]
-                ylo,yhi = yboxs[j]
-                cs = xlo+(random(N)*(xhi-xlo)) + 1j*(ylo+(random(N)*(yhi-ylo)))
-        
-                cvals.extend(list(cs))
+# kernel templates for the Buddhabrot, specialized for each update function by kernel_cache.specialize
+
+@kernel()
+def _orbit(c, args, maxiter, horizon, orbit):
+
+    """
+        writes the orbit of c into the preallocated orbit array, returns the number of points written
+        if the orbit escapes before maxiter and 0 otherwise
+    """
+
+    z = c
+
+    for n in range(maxiter):
+
+        orbit[n] = z
+
+        if abs(z) > horizon:
+            return n + 1
 
-    return np.array(cvals)
+        z = COMPLEX(update_func(z, c, args))
 
-@jit
-def buddhabrot(xbound, ybound, cvals, update_func, args=2, width=5, height=5, dpi=100, maxiter=100, horizon=1.0E6):
+    return 0
+
+@kernel()
+def _deposit(lattice, orbit, length, maxiters, xmin, xmax, ymin, ymax):
 
     """
-        computes the orbits of the cvals (output by compute_cvals) to form the Buddhabrot image
+        bins the orbit into every channel of the lattice whose maxiter it escapes under
     """
 
-    xmin,xmax = [float(xbound[0]),float(xbound[1])]
-    ymin,ymax = [float(ybound[0]),float(ybound[1])]
+    nchannels, nx, ny = lattice.shape
 
-    nx = width*dpi
-    ny = height*dpi
+    for k in range(length):
 
-    xvals  = np.array([xmin + i*(xmax-xmin)/(nx) for i in range(nx)], dtype=np.float32)
-    yvals  = np.array([ymin + i*(ymax-ymin)/(ny) for i in range(ny)], dtype=np.float32)
-    xboxs = [(xvals[i],xvals[i+1]) for i in range(len(xvals)-1)]
-    yboxs = [(yvals[i],yvals[i+1]) for i in range(len(yvals)-1)]
-    xboxs = xboxs + [(xboxs[-1][1], xmax)]
-    yboxs = yboxs + [(yboxs[-1][1], ymax)]
+        indx = pixel_index(orbit[k].real, xmin, xmax, nx)
+        indy = pixel_index(orbit[k].imag, ymin, ymax, ny)
 
-    lattice = np.zeros((int(width*dpi), int(height*dpi)), dtype=np.float32)
+        if indx >= 0 and indy >= 0:
+            for ch in range(nchannels):
+                if length <= maxiters[ch]:
+                    lattice[ch,indx,indy] += 1
 
-    for c in cvals:
+@kernel(parallel=True)
+def _accumulate_kernel(histograms, cvals, args, maxiters, horizon, xmin, xmax, ymin, ymax):
 
-        z = c
-        trial_sequence = []
-        sequence = []
+    """
+        adds the orbits of the cvals to the per-worker histograms (nworkers, nchannels, nx, ny), each worker takes
+        every nworkers-th c value and deposits into its own histogram (so there are no racing writes)
+    """
 
-        for N in range(maxiter):
-    
-            az = np.abs(z)
-            trial_sequence.append(z)
+    nworkers = histograms.shape[0]
+    maxiter = maxiters.max()
 
-            if az > horizon:
-                sequence.extend(trial_sequence)
-                break
+    for w in prange(nworkers):
 
-            z = update_func(z, c, args)
+        orbit = np.empty(maxiter, dtype=COMPLEX)
 
-        for c in sequence:
+        for k in range(w, len(cvals), nworkers):
+            length = _orbit(COMPLEX(cvals[k]), args, maxiter, horizon, orbit)
+            _deposit(histograms[w], orbit, length, maxiters, xmin, xmax, ymin, ymax)
 
-            indx = 0
-            indy = 0
-    
-            for bx in range(nx):
-                if xboxs[bx][0] < c.real < xboxs[bx][1]:
-                    indx += bx
-                    break
-    
-            for by in range(ny):
-                if yboxs[by][0] < c.imag < yboxs[by][1]:
-                    indy += by
-                    break
-    
-            if indx != 0 and indy != 0:
-                lattice[indx,indy] += 1
+@kernel(parallel=True)
+def _reduce_kernel(histograms):
+
+    """
+        the sum of the per-worker histograms
+    """
+
+    nworkers, nchannels, nx, ny = histograms.shape
+    lattice = histograms[0].copy()
 
-    return (lattice, width, height, dpi)
+    for i in prange(nx):
+        for w in range(1, nworkers):
+            lattice[:,i] += histograms[w,:,i]
 
-def run_nebula(xB, yB, Ncvals, update_func, gamma=0.5, args=2, importance_weight=0.5, width=5, height=5, dpi=100, maxiters=(100,1000,10000)):
+    return lattice
+
+@kernel(parallel=True)
+def _buddhabrot_kernel(cvals, args, maxiters, horizon, xmin, xmax, ymin, ymax, nx, ny, nworkers):
+
+    histograms = np.zeros((nworkers, len(maxiters), nx, ny), dtype=FLOAT)
+    _accumulate_kernel(histograms, cvals, args, maxiters, horizon, xmin, xmax, ymin, ymax)
+
+    return _reduce_kernel(histograms)
+
+BUDDHABROT_KERNELS = (_orbit, _deposit, _accumulate_kernel, _reduce_kernel, _buddhabrot_kernel)
+
+def _buddhabrot_worker(job):
+
+    xbound, ybound, cvals, update_func, args, width, height, dpi, maxiters, horizon, precision = job
+    channels = buddhabrot_channels(xbound, ybound, cvals, update_func, args=args, width=width, height=height, dpi=dpi, maxiters=maxiters, horizon=horizon, workers=1,
+                                   precision=precision)
+
+    return np.array([L for L, w, h, d in channels])
+
+def buddhabrot_channels(xbound, ybound, cvals, update_func, args=2, width=5, height=5, dpi=100, maxiters=(100,1000,10000), horizon=1.0E6, workers=None, backend='threads',
+                        precision='double'):
+
+    """
+        computes the Buddhabrot for several maxiters in a single pass, each c value is iterated once up to the
+        largest maxiter and its orbit is deposited into every channel whose maxiter it escapes under, returns a
+        list with one (lattice, width, height, dpi) tuple per maxiter
+
+        the cvals are split between workers (default is the kernel thread count) that each accumulate into a
+        private histogram, backend='threads' runs them as nopython threads and backend='processes' runs them in
+        a process pool, precision='single' iterates the orbits in complex64 and accumulates float32 lattices (see
+        grid.precision_dtype)
+    """
+
+    xmin, xmax, ymin, ymax, nx, ny = viewport(xbound, ybound, width=width, height=height, dpi=dpi)
+    maxiters = np.array(maxiters, dtype=np.int64)
+    workers = get_num_threads() if workers is None else int(workers)
+    dtype = precision_dtype(precision, xbound, ybound, width=width, height=height, dpi=dpi)
+
+    if backend == 'threads':
+        kernels = specialize(update_func, BUDDHABROT_KERNELS, dtype)
+        lattice = kernels._buddhabrot_kernel(cvals, args, maxiters, horizon, xmin, xmax, ymin, ymax, nx, ny, workers)
+    elif backend == 'processes':
+        # spawn rather than fork, numba's threading layer is not fork safe
+        jobs = [(xbound, ybound, cvals[w::workers], update_func, args, width, height, dpi, maxiters, horizon, 'single' if dtype is np.float32 else 'double') for w in range(workers)]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+            lattice = sum(pool.map(_buddhabrot_worker, jobs))
+    else:
+        raise ValueError('backend must be threads or processes')
+
+    return [(L, width, height, dpi) for L in lattice]
+
+def buddhabrot(xbound, ybound, cvals, update_func, args=2, width=5, height=5, dpi=100, maxiter=100, horizon=1.0E6, workers=None, backend='threads', precision='double'):
+
+    """
+        computes the orbits of the cvals (output by compute_cvals) to form the Buddhabrot image, orbit points
+        are binned into the lattice in O(1) by computing their pixel index directly, precision is 'double' or 'single'
+    """
+
+    return buddhabrot_channels(xbound, ybound, cvals, update_func, args=args, width=width, height=height, dpi=dpi, maxiters=(maxiter,), horizon=horizon, workers=workers, backend=backend,
+                               precision=precision)[0]
+
+def _save_checkpoint(checkpoint, lattice, done, rng, params):
+
+    with open(checkpoint + '.tmp', 'wb') as f:
+        np.savez(f, lattice=lattice, done=done, rng_state=json.dumps(rng.bit_generator.state), params=json.dumps(params))
+
+    os.replace(checkpoint + '.tmp', checkpoint)
+
+def stream_buddhabrot(xbound, ybound, Ncvals, update_func, args=2, width=5, height=5, dpi=100, maxiters=(100,1000,10000), horizon=1.0E6, importance_weight=0.75,
+                      batch_size=100000, seed=None, checkpoint=None, checkpoint_every=10**7, previews=(), gamma=0.5, workers=None):
+
+    """
+        accumulates buddhabrot_channels over lazily drawn batches of c values (see cval_batches), if a checkpoint file
+        is given the lattices and the RNG state are written to it every checkpoint_every samples, if it exists (and was
+        made with the same parameters) the job resumes where it stopped, and it is deleted once the job finishes, a nebula
+        image (3 maxiters) or image (1 maxiter) preview named preview_<samples> is written when the number of samples
+        passes each value in previews
+    """
+
+    xmin, xmax, ymin, ymax, nx, ny = viewport(xbound, ybound, width=width, height=height, dpi=dpi)
+    params = dict(bounds=[xmin, xmax, ymin, ymax], shape=[nx, ny], Ncvals=Ncvals, maxiters=list(maxiters), horizon=horizon, args=repr(args),
+                  update_func=update_func.__name__, importance_weight=importance_weight, batch_size=batch_size, seed=seed)
+
+    rng = np.random.default_rng(seed)
+    workers = get_num_threads() if workers is None else int(workers)
+    kernels = specialize(update_func, BUDDHABROT_KERNELS)
+
+    # the per-worker histograms are kept across batches and only reduced for checkpoints, previews and the result
+    histograms = np.zeros((workers, len(maxiters), nx, ny), dtype=np.float64)
+    done = 0
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+
+        saved = np.load(checkpoint)
+
+        if json.loads(str(saved['params'])) != params:
+            raise ValueError('checkpoint ' + checkpoint + ' was made with different parameters')
+
+        histograms[0] = saved['lattice']
+        done = int(saved['done'])
+        rng.bit_generator.state = json.loads(str(saved['rng_state']))
+
+    previews = sorted(p for p in previews if p > done)
+    last_checkpoint = done
+    maxiters = np.array(maxiters, dtype=np.int64)
+    batches = cval_batches(Ncvals - done, xbound, ybound, update_func, args=args, width=width, height=height, dpi=dpi,
+                           importance_weight=importance_weight, batch_size=batch_size, rng=rng)
+
+    for cvals in batches:
+
+        kernels._accumulate_kernel(histograms, cvals, args, maxiters, horizon, xmin, xmax, ymin, ymax)
+        done += len(cvals)
+
+        if checkpoint is not None and done - last_checkpoint >= checkpoint_every and done < Ncvals:
+            _save_checkpoint(checkpoint, kernels._reduce_kernel(histograms), done, rng, params)
+            last_checkpoint = done
+
+        while previews and done >= previews[0]:
+            name = 'preview_%s' % previews.pop(0)
+            lattice = kernels._reduce_kernel(histograms)
+            if len(lattice) == 3:
+                nebula_image(*[(L, width, height, dpi) for L in lattice], gamma=gamma, filename=name)
+            else:
+                image((lattice[0], width, height, dpi), gamma=gamma, filename=name)
+
+    lattices = [(L, width, height, dpi) for L in kernels._reduce_kernel(histograms)]
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    return lattices
+
+def run_nebula(xB, yB, Ncvals, update_func, gamma=0.5, args=2, importance_weight=0.5, width=5, height=5, dpi=100, maxiters=(100,1000,10000), workers=None, backend='threads', seed=None):
 
     """
         calculates 3 Buddhabrot image with different maxiters, lowest maxiter = red channgel, middle = green, highest = blue
-        (looks like a nebula)
+        (looks like a nebula), all three are accumulated in a single pass over the cvals
     """
 
     start_time = time.time()
-    mi0, mi1, mi2 = maxiters
     
-    cvals = compute_cvals(Ncvals, xB, yB, update_func, args=args, width=width, height=height, dpi=dpi, importance_weight=importance_weight)
+    cvals = compute_cvals(Ncvals, xB, yB, update_func, args=args, width=width, height=height, dpi=dpi, importance_weight=importance_weight, seed=seed)
 
-    bud0 = buddhabrot(xB, yB, cvals, update_func, args=args, horizon=1.0E6, maxiter=mi0, width=width, height=height, dpi=dpi)
-    save_image_array(bud0, name='save0')
-    
-    bud1 = buddhabrot(xB, yB, cvals, update_func, args=args, horizon=1.0E6, maxiter=mi1, width=width, height=height, dpi=dpi)
-    save_image_array(bud1, name='save1')
-    
-    bud2 = buddhabrot(xB, yB, cvals, update_func, args=args, horizon=1.0E6, maxiter=mi2, width=width, height=height, dpi=dpi)
-    save_image_array(bud2, name='save2')
+    bud0, bud1, bud2 = buddhabrot_channels(xB, yB, cvals, update_func, args=args, horizon=1.0E6, maxiters=maxiters, width=width, height=height, dpi=dpi, workers=workers, backend=backend)
+    for k, bud in enumerate((bud0, bud1, bud2)):
+        save_image_array(bud, name='save' + str(k), bounds=[xB, yB], maxiter=maxiters[k], update_func=update_func, seed=seed)
     
     nebula_image(bud0, bud1, bud2, gamma=gamma)
     
@@ -1,139 +1,858 @@
+import os
+import json
+import warnings
 import numpy as np
-from numpy import log, conj
+from numpy import log, conj, inf
 from cmath import sin, cos, exp
-from numba import jit, prange
+from numba import njit, prange, types
+from numba.extending import overload
+from numba.np.numpy_support import as_dtype
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import get_context
+from kernel_cache import kernel, specialize, get_num_threads, set_num_threads, threadsafe_layer
+from grid import viewport, grid, precision_dtype
 
 pi  = np.pi
 phi = (1 + 5 ** 0.5) / 2
 
 # these are the "update" functions that can be applied to grid points iteratively "power" with n=2
-# is the "typical" Mandelbrot function
+# is the "typical" Mandelbrot function, each is declared with @update_function, which compiles it and registers it
+# by name in UPDATE_FUNCS (kernels are specialized and cached per update function, see kernel_cache)
 
-@jit
+UPDATE_FUNCS = {}
+
+def update_function(func):
+
+    """
+        declares an update function f(z, c, args) -> z, returns the compiled function and registers it by name
+    """
+
+    compiled = njit(nogil=True)(func)
+    UPDATE_FUNCS[func.__name__] = compiled
+
+    return compiled
+
+@njit(cache=True, nogil=True, error_model='numpy')
+def _ipow(z, n, one):
+
+    """
+        z**n for an integer n by repeated squaring, log2(n) multiplications instead of a complex pow,
+        one (1 in the type of z) keeps single precision values in single precision, negative powers divide by
+        |z|**2 under the numpy error model so 0**-n is nan (as with numba's complex pow) instead of raising
+    """
+
+    k = abs(n)
+    result = one
+    base = z
+
+    while k > 0:
+        if k & 1:
+            result = result*base
+        k >>= 1
+        if k > 0:
+            base = base*base
+
+    if n >= 0:
+        return result
+
+    r = abs(result)
+
+    return result.conjugate()*(one.real/(r*r))
+
+def ipow(z, n):
+
+    """
+        z**n, computed by repeated multiplication in compiled code when n is an integer
+    """
+
+    return z**n
+
+@overload(ipow)
+def _ipow_overload(z, n):
+
+    if not isinstance(n, types.Integer):
+        return lambda z, n: z**n
+
+    one = as_dtype(z).type(1)
+
+    return lambda z, n: _ipow(z, n, one)
+
+# the kernels of power and conj_power are keyed on these as well, see kernel_cache.update_func_key
+ipow.depends = (_ipow_overload, _ipow)
+
+@update_function
 def power(z, c, n):
-    return z**n + c
+    return (z*z if n == 2 else ipow(z, n)) + c
 
-@jit
+@update_function
 def conj_power(z, c, n):
-    return conj(z)**n + c
+    w = conj(z)
+    return (w*w if n == 2 else ipow(w, n)) + c
 
-@jit
+@update_function
 def cosine(z, c, args):
     return c*cos(z)
 
-@jit
+@update_function
 def sine(z, c, args):
     return c*sin(z)
 
-@jit
+@update_function
 def exponential(z, c, args):
     return c*exp(z)
 
-@jit
+@update_function
 def magnetic_1(z, c, args):
-    return ( (z*z+c-1) / (2*z+c-2) ) * ( (z*z+c-1) / (2*z+c-2) )
+    q = (z*z+c-1) / (2*z+c-2)
+    return q*q
 
-@jit
+@update_function
 def magnetic_2(z, c, args):
-    return ( (z*z*z * 3*(c-1)*z + (c-1)*(c-2) ) / ( 3*z*z + 3*(c-2)*z + (c-1)*(c-2) + 1) ) * ( (z*z*z * 3*(c-1)*z + (c-1)*(c-2) ) / ( 3*z*z + 3*(c-2)*z + (c-1)*(c-2) + 1) )
+    q = (z*z*z * 3*(c-1)*z + (c-1)*(c-2)) / (3*z*z + 3*(c-2)*z + (c-1)*(c-2) + 1)
+    return q*q
 
-# functions for Mandelbrot and Julia set array creation (can then be turned into images)
+# kernel templates for Mandelbrot and Julia set array creation, these are specialized for each update function
+# (and dtype) by kernel_cache.specialize, which compiles them as parallel nopython kernels
 
-@jit
-def mandelbrot(xbound, ybound, update_func, args=2, width=5, height=5, dpi=100, maxiter=100, horizon=2.0**40, log_smooth=True):
+@kernel()
+def _escape_time(z, c, args, maxiter, horizon, log_horizon, log_smooth):
 
     """
-        function for producing Mandelbrot array, log_smooth reduces sharp changes in coloration
+        the (smoothed) escape iteration of z, an orbit that overflows to inf on escaping is given its integer
+        escape iteration, the smoothing term would be -inf
+    """
+
+    for n in range(maxiter):
+
+        az = abs(z)
+
+        if az > horizon:
+            if log_smooth and az < inf:
+                return n - log(log(az))/log(2) + log_horizon
+            return n
+
+        z = COMPLEX(update_func(z, c, args))
+
+    return 0.0
+
+@kernel()
+def _escape_time_periodic(z, c, args, maxiter, horizon, log_horizon, log_smooth, period_tol):
+
+    """
+        _escape_time with Brent-style periodicity checking, z is compared to a saved iterate that is
+        refreshed at doubling intervals, if the orbit returns to within period_tol of it the point is
+        taken to be in a cycle (interior), returns the value and the number of iterations skipped
     """
 
-    xmin,xmax = [float(xbound[0]),float(xbound[1])]
-    ymin,ymax = [float(ybound[0]),float(ybound[1])]
+    z_saved = z
+    steps = 0
+    interval = 1
 
-    nx = width*dpi
-    ny = height*dpi
+    for n in range(maxiter):
 
-    xvals  = np.array([xmin + i*(xmax - xmin)/(nx) for i in range(nx)], dtype=np.float64)
-    yvals  = np.array([ymin + i*(ymax - ymin)/(ny) for i in range(ny)], dtype=np.float64)
+        az = abs(z)
 
-    lattice = np.zeros((int(nx), int(ny)), dtype=np.float64)
+        if az > horizon:
+            if log_smooth and az < inf:
+                return n - log(log(az))/log(2) + log_horizon, 0
+            return n, 0
 
+        z = COMPLEX(update_func(z, c, args))
+
+        if abs(z - z_saved) < period_tol:
+            return 0.0, maxiter - n - 1
+
+        steps += 1
+        if steps == interval:
+            z_saved = z
+            steps = 0
+            interval *= 2
+
+    return 0.0, 0
+
+@kernel()
+def _in_main_bulbs(c):
+
+    """
+        True if c is in the main cardioid or the period-2 bulb of the z**2 + c Mandelbrot set
+    """
+
+    x = c.real - 0.25
+    y2 = c.imag * c.imag
+    q = x*x + y2
+
+    if q*(q + x) <= 0.25*y2:
+        return True
+
+    return (c.real + 1.0)**2 + y2 <= 0.0625
+
+@kernel(parallel=True)
+def _mandelbrot_kernel(xvals, yvals, args, maxiter, horizon, log_smooth, period_tol, bulbs):
+
+    lattice = np.zeros((len(xvals), len(yvals)), dtype=FLOAT)
+    log_horizon = log(log(horizon))/log(2)
+    saved = 0
+
+    for i in prange(len(xvals)):
+        for j in range(len(yvals)):
+            c = COMPLEX(xvals[i] + 1j * yvals[j])
+            if bulbs and _in_main_bulbs(c):
+                saved += maxiter
+            elif period_tol > 0.0:
+                value, skipped = _escape_time_periodic(c, c, args, maxiter, horizon, log_horizon, log_smooth, period_tol)
+                lattice[i,j] = value
+                saved += skipped
+            else:
+                lattice[i,j] = _escape_time(c, c, args, maxiter, horizon, log_horizon, log_smooth)
+
+    return lattice, saved
+
+@kernel(parallel=True)
+def _julia_kernel(c, xvals, yvals, args, maxiter, horizon, log_smooth, period_tol):
+
+    lattice = np.zeros((len(xvals), len(yvals)), dtype=FLOAT)
     log_horizon = log(log(horizon))/log(2)
+    c = COMPLEX(c)
+    saved = 0
 
     for i in prange(len(xvals)):
-        for j in prange(len(yvals)):
+        for j in range(len(yvals)):
+            z = COMPLEX(xvals[i] + 1j * yvals[j])
+            if period_tol > 0.0:
+                value, skipped = _escape_time_periodic(z, c, args, maxiter, horizon, log_horizon, log_smooth, period_tol)
+                lattice[i,j] = value
+                saved += skipped
+            else:
+                lattice[i,j] = _escape_time(z, c, args, maxiter, horizon, log_horizon, log_smooth)
 
-            c = xvals[i] + 1j * yvals[j]
-            z = c
+    return lattice, saved
 
-            for n in prange(maxiter):
+@kernel()
+def _pixel(lattice, done, i, j, xvals, yvals, c, is_julia, args, maxiter, horizon, log_horizon, log_smooth, period_tol):
 
-                az = abs(z)
+    """
+        computes pixel i,j of a Mandelbrot (is_julia=False) or Julia lattice unless it is already done
+    """
 
-                if az > horizon:
-                    if log_smooth:
-                        lattice[i,j] = n - log(log(az))/log(2) + log_horizon
-                    else:
-                        lattice[i,j] = n
+    if not done[i,j]:
+
+        z = COMPLEX(xvals[i] + 1j * yvals[j])
+        if not is_julia:
+            c = z
+
+        if period_tol > 0.0:
+            lattice[i,j] = _escape_time_periodic(z, c, args, maxiter, horizon, log_horizon, log_smooth, period_tol)[0]
+        else:
+            lattice[i,j] = _escape_time(z, c, args, maxiter, horizon, log_horizon, log_smooth)
+
+        done[i,j] = True
+
+    return lattice[i,j]
+
+@kernel(parallel=True)
+def _mariani_silver_kernel(xvals, yvals, c, is_julia, args, maxiter, horizon, log_smooth, period_tol, tile, min_size):
+
+    """
+        Mariani-Silver rendering, each tile of the lattice is subdivided recursively (using an explicit stack), only the
+        border of each rectangle is computed and the rectangle is filled when its border is uniform, with log_smooth
+        the values vary continuously so only all-interior (0) rectangles are filled
+    """
+
+    nx = len(xvals)
+    ny = len(yvals)
+    lattice = np.zeros((nx, ny), dtype=FLOAT)
+    done = np.zeros((nx, ny), dtype=np.bool_)
+    log_horizon = log(log(horizon))/log(2)
+    c = COMPLEX(c)
+
+    ntx = (nx + tile - 1)//tile
+    nty = (ny + tile - 1)//tile
+    computed = 0
+
+    for t in prange(ntx*nty):
+
+        stack = np.empty((4*tile, 4), dtype=np.int64)
+        stack[0,0] = (t//nty)*tile
+        stack[0,1] = min(stack[0,0] + tile, nx)
+        stack[0,2] = (t%nty)*tile
+        stack[0,3] = min(stack[0,2] + tile, ny)
+        top = 1
+        filled = 0
+
+        while top > 0:
+
+            top -= 1
+            x0, x1, y0, y1 = stack[top,0], stack[top,1], stack[top,2], stack[top,3]
+
+            if x1 - x0 <= min_size or y1 - y0 <= min_size:
+                for i in range(x0, x1):
+                    for j in range(y0, y1):
+                        _pixel(lattice, done, i, j, xvals, yvals, c, is_julia, args, maxiter, horizon, log_horizon, log_smooth, period_tol)
+                continue
+
+            v = _pixel(lattice, done, x0, y0, xvals, yvals, c, is_julia, args, maxiter, horizon, log_horizon, log_smooth, period_tol)
+            uniform = not log_smooth or v == 0.0
+
+            for i in range(x0, x1):
+                if not uniform:
                     break
+                uniform = (_pixel(lattice, done, i, y0, xvals, yvals, c, is_julia, args, maxiter, horizon, log_horizon, log_smooth, period_tol) == v and
+                           _pixel(lattice, done, i, y1-1, xvals, yvals, c, is_julia, args, maxiter, horizon, log_horizon, log_smooth, period_tol) == v)
 
-                z = update_func(z, c, args)
+            for j in range(y0, y1):
+                if not uniform:
+                    break
+                uniform = (_pixel(lattice, done, x0, j, xvals, yvals, c, is_julia, args, maxiter, horizon, log_horizon, log_smooth, period_tol) == v and
+                           _pixel(lattice, done, x1-1, j, xvals, yvals, c, is_julia, args, maxiter, horizon, log_horizon, log_smooth, period_tol) == v)
 
-    return (lattice, width, height, dpi)
+            if uniform:
+                for i in range(x0 + 1, x1 - 1):
+                    for j in range(y0 + 1, y1 - 1):
+                        lattice[i,j] = v
+                        done[i,j] = True
+                filled += (x1 - x0 - 2)*(y1 - y0 - 2)
+            else:
+                xm = (x0 + x1)//2
+                ym = (y0 + y1)//2
+                for xa, xb, ya, yb in ((x0, xm, y0, ym), (xm, x1, y0, ym), (x0, xm, ym, y1), (xm, x1, ym, y1)):
+                    stack[top,0], stack[top,1], stack[top,2], stack[top,3] = xa, xb, ya, yb
+                    top += 1
+
+        computed += min(tile, nx - (t//nty)*tile)*min(tile, ny - (t%nty)*tile) - filled
+
+    return lattice, computed
 
-@jit
-def julia(c, xbound, ybound, update_func, args=2, width=5, height=5, dpi=100, maxiter=100, horizon=2.0**40, log_smooth=True):
+@kernel()
+def _guided_pixel(lattice, done, i, j, xvals, yvals, c, prev, args, maxiter, horizon, log_horizon, log_smooth, period_tol):
 
     """
-        function for producing Julia array, log_smooth reduces sharp changes in coloration
+        _pixel for a Julia lattice with periodicity checking only where the previous frame was interior
     """
 
-    xmin,xmax = [float(xbound[0]),float(xbound[1])]
-    ymin,ymax = [float(ybound[0]),float(ybound[1])]
+    tol = period_tol if prev[i,j] == 0.0 else 0.0
 
-    nx = width*dpi
-    ny = height*dpi
+    return _pixel(lattice, done, i, j, xvals, yvals, c, True, args, maxiter, horizon, log_horizon, log_smooth, tol)
 
-    xvals  = np.array([xmin + i*(xmax - xmin)/(nx) for i in range(nx)], dtype=np.float64)
-    yvals  = np.array([ymin + i*(ymax - ymin)/(ny) for i in range(ny)], dtype=np.float64)
+@kernel(parallel=True)
+def _julia_incremental_kernel(c, xvals, yvals, prev, args, maxiter, horizon, log_smooth, period_tol, block):
 
-    lattice = np.zeros((int(nx), int(ny)), dtype=np.float64)
+    """
+        a Julia lattice computed with the previous frame of a series (prev) as a guide, blocks that were uniform in prev
+        (interior, or a single escape count without log_smooth) only have their border computed and are filled when it
+        is still uniform, everything else is recomputed exactly (pixels that were interior in prev with periodicity
+        checking, if period_tol > 0), returns the lattice and the number of pixels iterated
+
+        a filled block is not iterated, so as with mariani_silver (see _escape_render) the result is exact when the set
+        is connected, for maps with disconnected sets (e.g. magnetic_1) a component that appears inside a block whose
+        border is unchanged is missed (julia_series(verify=True) reports these pixels)
+    """
 
+    nx = len(xvals)
+    ny = len(yvals)
+    lattice = np.zeros((nx, ny), dtype=FLOAT)
+    done = np.zeros((nx, ny), dtype=np.bool_)
     log_horizon = log(log(horizon))/log(2)
+    c = COMPLEX(c)
 
-    for i in prange(len(xvals)):
-        for j in prange(len(yvals)):
+    nbx = (nx + block - 1)//block
+    nby = (ny + block - 1)//block
+    computed = 0
 
-            z = xvals[i] + 1j * yvals[j]
+    for b in prange(nbx*nby):
 
-            for n in range(maxiter):
+        x0 = (b//nby)*block
+        x1 = min(x0 + block, nx)
+        y0 = (b%nby)*block
+        y1 = min(y0 + block, ny)
 
-                az = abs(z)
+        v = prev[x0,y0]
+        uniform = (not log_smooth or v == 0.0) and x1 - x0 > 2 and y1 - y0 > 2
 
-                if az > horizon:
-                    if log_smooth:
-                        lattice[i,j] = n - log(log(az))/log(2) + log_horizon
-                    else:
-                        lattice[i,j] = n
+        for i in range(x0, x1):
+            if not uniform:
+                break
+            for j in range(y0, y1):
+                if prev[i,j] != v:
+                    uniform = False
                     break
 
-                z = update_func(z, c, args)
+        tested = uniform
+
+        for i in range(x0, x1):
+            if not uniform:
+                break
+            uniform = (_guided_pixel(lattice, done, i, y0, xvals, yvals, c, prev, args, maxiter, horizon, log_horizon, log_smooth, period_tol) == v and
+                       _guided_pixel(lattice, done, i, y1-1, xvals, yvals, c, prev, args, maxiter, horizon, log_horizon, log_smooth, period_tol) == v)
+
+        for j in range(y0, y1):
+            if not uniform:
+                break
+            uniform = (_guided_pixel(lattice, done, x0, j, xvals, yvals, c, prev, args, maxiter, horizon, log_horizon, log_smooth, period_tol) == v and
+                       _guided_pixel(lattice, done, x1-1, j, xvals, yvals, c, prev, args, maxiter, horizon, log_horizon, log_smooth, period_tol) == v)
+
+        if uniform:
+            for i in range(x0 + 1, x1 - 1):
+                for j in range(y0 + 1, y1 - 1):
+                    lattice[i,j] = v
+            computed += (x1 - x0)*(y1 - y0) - (x1 - x0 - 2)*(y1 - y0 - 2)
+        elif not tested:
+            for i in range(x0, x1):
+                for j in range(y0, y1):
+                    z = COMPLEX(xvals[i] + 1j * yvals[j])
+                    if period_tol > 0.0 and prev[i,j] == 0.0:
+                        lattice[i,j] = _escape_time_periodic(z, c, args, maxiter, horizon, log_horizon, log_smooth, period_tol)[0]
+                    else:
+                        lattice[i,j] = _escape_time(z, c, args, maxiter, horizon, log_horizon, log_smooth)
+            computed += (x1 - x0)*(y1 - y0)
+        else:
+            for i in range(x0, x1):
+                for j in range(y0, y1):
+                    _guided_pixel(lattice, done, i, j, xvals, yvals, c, prev, args, maxiter, horizon, log_horizon, log_smooth, period_tol)
+            computed += (x1 - x0)*(y1 - y0)
+
+    return lattice, computed
+
+@kernel(parallel=True)
+def _resume_kernel(idx, z, xvals, yvals, c, is_julia, args, start, maxiter, horizon, log_smooth, values, escaped):
+
+    """
+        continues the orbits of the pixels idx (flat indices) from their iterates z, which have had start iterations,
+        up to maxiter, escaping pixels get their value (as _escape_time would give it) and are flagged in escaped, z is
+        updated in place for the rest
+    """
+
+    ny = len(yvals)
+    log_horizon = log(log(horizon))/log(2)
+    c = COMPLEX(c)
+
+    for k in prange(len(idx)):
+
+        i = idx[k]//ny
+        j = idx[k]%ny
+        zk = z[k]
+        ck = c if is_julia else COMPLEX(xvals[i] + 1j * yvals[j])
+
+        for n in range(start, maxiter):
+
+            az = abs(zk)
+
+            if az > horizon:
+                if log_smooth and az < inf:
+                    values[k] = n - log(log(az))/log(2) + log_horizon
+                else:
+                    values[k] = n
+                escaped[k] = True
+                break
+
+            zk = COMPLEX(update_func(zk, ck, args))
+
+        z[k] = zk
+
+@kernel(parallel=True)
+def _supersample_kernel(pixels, offsets, xvals, yvals, dx, dy, c, is_julia, args, maxiter, horizon, log_smooth):
+
+    """
+        the mean escape time of the sub-samples of each pixel in pixels (rows of i, j), sub-sample s of pixel p
+        is offset by offsets[p,s] (in units of the pixel spacing dx, dy) from the pixel's lower corner
+    """
+
+    values = np.zeros(len(pixels), dtype=FLOAT)
+    log_horizon = log(log(horizon))/log(2)
+    c = COMPLEX(c)
+    nsamples = offsets.shape[1]
+
+    for p in prange(len(pixels)):
+
+        i = pixels[p,0]
+        j = pixels[p,1]
+        total = 0.0
+
+        for s in range(nsamples):
+            z = COMPLEX(xvals[i] + offsets[p,s,0]*dx + 1j * (yvals[j] + offsets[p,s,1]*dy))
+            ck = c if is_julia else z
+            total += _escape_time(z, ck, args, maxiter, horizon, log_horizon, log_smooth)
+
+        values[p] = total/nsamples
+
+    return values
+
+ESCAPE_KERNELS = (_escape_time, _escape_time_periodic, _in_main_bulbs, _mandelbrot_kernel, _julia_kernel, _pixel, _mariani_silver_kernel,
+                  _guided_pixel, _julia_incremental_kernel, _resume_kernel, _supersample_kernel)
+
+def _horizon(horizon, dtype, update_func, args):
+
+    """
+        the escape radius used by the kernels, in single precision it is lowered for power maps of degree above 2 so
+        that the iterate after escaping (about horizon**args) stays far below the float32 maximum (2**128)
+    """
+
+    if dtype == np.float32 and (update_func is power or update_func is conj_power) and np.isscalar(args) and args > 2:
+        return min(horizon, 2.0**(100/args))
+
+    return horizon
+
+def _shift_smoothing(values, horizon, kernel_horizon, log_smooth):
+
+    """
+        shifts smoothed escape times computed with the lower kernel_horizon (see _horizon) by the difference in the
+        log_horizon term, which puts them back in line with the values horizon gives
+    """
+
+    if log_smooth and kernel_horizon < horizon:
+        values[values != 0] += log(log(horizon)/log(kernel_horizon))/log(2)
+
+    return values
+
+def _period_tol(xbound, ybound, width, height, dpi):
+
+    """
+        the periodicity checking tolerance, a small fraction of the pixel spacing
+    """
+
+    xmin, xmax, ymin, ymax, nx, ny = viewport(xbound, ybound, width=width, height=height, dpi=dpi)
+
+    return 1e-3 * min((xmax - xmin)/nx, (ymax - ymin)/ny)
+
+def _edge_pixels(lattice, threshold):
+
+    """
+        the (i, j) indices of the pixels that differ from one of their 4 neighbors by more than threshold
+    """
+
+    edges = np.zeros(lattice.shape, dtype=np.bool_)
+
+    for axis in (0, 1):
+        d = np.abs(np.diff(lattice, axis=axis)) > threshold
+        lo = [slice(None), slice(None)]
+        hi = [slice(None), slice(None)]
+        lo[axis] = slice(None, -1)
+        hi[axis] = slice(1, None)
+        edges[tuple(lo)] |= d
+        edges[tuple(hi)] |= d
+
+    return np.argwhere(edges)
+
+def _antialias(lattice, c, is_julia, xbound, ybound, update_func, args, width, height, dpi, maxiter, horizon, log_smooth, samples, threshold, stats):
+
+    """
+        adaptive supersampling, the pixels whose smoothed escape time differs from a neighbor's by more than threshold
+        are replaced (in place) by the mean of samples x samples jittered sub-samples (one in each cell of a regular
+        grid over the pixel), stats['pixels_refined'] is the number of pixels supersampled
+    """
+
+    pixels = _edge_pixels(lattice, threshold)
+
+    xmin, xmax, ymin, ymax, nx, ny = viewport(xbound, ybound, width=width, height=height, dpi=dpi)
+    xvals, yvals = grid(xbound, ybound, width=width, height=height, dpi=dpi, dtype=lattice.dtype)
+
+    # stratified jitter, the same for every render of a view
+    cells = (np.arange(samples*samples).reshape(-1, 1) // [samples, 1]) % samples
+    offsets = (cells + np.random.default_rng(0).random((len(pixels), samples*samples, 2)))/samples
+
+    kernel_horizon = _horizon(horizon, lattice.dtype, update_func, args)
+    kernels = specialize(update_func, ESCAPE_KERNELS, lattice.dtype)
+    values = kernels._supersample_kernel(pixels, offsets, xvals, yvals, (xmax - xmin)/nx, (ymax - ymin)/ny, complex(c), is_julia, args, maxiter, kernel_horizon,
+                                         log_smooth)
+    lattice[pixels[:,0], pixels[:,1]] = _shift_smoothing(values, horizon, kernel_horizon, log_smooth)
+
+    if stats is not None:
+        stats['pixels_refined'] = len(pixels)
+
+    return lattice
+
+# functions for Mandelbrot and Julia set array creation (can then be turned into images)
+
+def _escape_render(c, is_julia, xbound, ybound, update_func, args, width, height, dpi, maxiter, horizon, log_smooth, interior, stats, method, precision='double',
+                   tile=64, min_size=4):
+
+    """
+        renders a Mandelbrot or Julia array with an alternative to the brute force (every pixel) method,
+        'mariani_silver' computes only the borders of recursively subdivided rectangles and fills those
+        with uniform borders, stats['pixels_computed'] is the number of pixels actually iterated, the result matches
+        brute force exactly (for log_smooth=False) when the set is connected, for maps with disconnected sets (e.g.
+        magnetic_1) a small component enclosed by a uniform border is missed
+    """
+
+    if method != 'mariani_silver':
+        raise ValueError('method must be brute or mariani_silver')
+
+    dtype = precision_dtype(precision, xbound, ybound, width=width, height=height, dpi=dpi)
+    xvals, yvals = grid(xbound, ybound, width=width, height=height, dpi=dpi, dtype=dtype)
+    period_tol = _period_tol(xbound, ybound, width, height, dpi) if interior else 0.0
+    kernel_horizon = _horizon(horizon, dtype, update_func, args)
+
+    kernels = specialize(update_func, ESCAPE_KERNELS, dtype)
+    lattice, computed = kernels._mariani_silver_kernel(xvals, yvals, complex(c), is_julia, args, maxiter, kernel_horizon, log_smooth, period_tol, tile, min_size)
+    _shift_smoothing(lattice, horizon, kernel_horizon, log_smooth)
+
+    if stats is not None:
+        stats['pixels_computed'] = computed
+
+    return (lattice, width, height, dpi)
+
+def mandelbrot(xbound, ybound, update_func, args=2, width=5, height=5, dpi=100, maxiter=100, horizon=2.0**40, log_smooth=True, interior=False, stats=None, method='brute',
+               precision='double', antialias=1, aa_threshold=1.0):
+
+    """
+        function for producing Mandelbrot array, log_smooth reduces sharp changes in coloration
+
+        interior=True skips work on interior points, points in the main cardioid and period-2 bulb are rejected outright
+        (for power with n=2) and any orbit that falls into a cycle is stopped early (periodicity checking), if a dict
+        is passed as stats the number of iterations saved is stored in stats['iterations_saved']
+
+        method='mariani_silver' renders by rectangle subdivision (see _escape_render), otherwise every pixel is iterated
+
+        precision='single' iterates in complex64 and returns a float32 lattice, for quick previews of shallow views (it
+        falls back to double precision, with a warning, once pixels are too small for float32, see grid.precision_dtype)
+
+        antialias > 1 supersamples the pixels that differ from a neighbor by more than aa_threshold (in smoothed iterations)
+        with antialias x antialias jittered sub-samples each, rather than rendering everything at a higher dpi, the number
+        of pixels supersampled is stored in stats['pixels_refined'] (see _antialias)
+    """
+
+    if method != 'brute':
+        lattice = _escape_render(0j, False, xbound, ybound, update_func, args, width, height, dpi, maxiter, horizon, log_smooth, interior, stats, method, precision)[0]
+    else:
+        dtype = precision_dtype(precision, xbound, ybound, width=width, height=height, dpi=dpi)
+        xvals, yvals = grid(xbound, ybound, width=width, height=height, dpi=dpi, dtype=dtype)
+        period_tol = _period_tol(xbound, ybound, width, height, dpi) if interior else 0.0
+        bulbs = interior and update_func is power and args == 2
+        kernel_horizon = _horizon(horizon, dtype, update_func, args)
+
+        kernels = specialize(update_func, ESCAPE_KERNELS, dtype)
+        lattice, saved = kernels._mandelbrot_kernel(xvals, yvals, args, maxiter, kernel_horizon, log_smooth, period_tol, bulbs)
+        _shift_smoothing(lattice, horizon, kernel_horizon, log_smooth)
+
+        if stats is not None:
+            stats['iterations_saved'] = saved
+
+    if antialias > 1:
+        _antialias(lattice, 0j, False, xbound, ybound, update_func, args, width, height, dpi, maxiter, horizon, log_smooth, antialias, aa_threshold, stats)
+
+    return (lattice, width, height, dpi)
+
+def julia(c, xbound, ybound, update_func, args=2, width=5, height=5, dpi=100, maxiter=100, horizon=2.0**40, log_smooth=True, interior=False, stats=None, method='brute',
+          precision='double', antialias=1, aa_threshold=1.0):
+
+    """
+        function for producing Julia array, log_smooth reduces sharp changes in coloration, interior=True
+        stops orbits that fall into a cycle early, method selects the renderer, precision the float type and antialias the
+        adaptive supersampling (see mandelbrot)
+    """
+
+    if method != 'brute':
+        lattice = _escape_render(c, True, xbound, ybound, update_func, args, width, height, dpi, maxiter, horizon, log_smooth, interior, stats, method, precision)[0]
+    else:
+        dtype = precision_dtype(precision, xbound, ybound, width=width, height=height, dpi=dpi)
+        xvals, yvals = grid(xbound, ybound, width=width, height=height, dpi=dpi, dtype=dtype)
+        period_tol = _period_tol(xbound, ybound, width, height, dpi) if interior else 0.0
+        kernel_horizon = _horizon(horizon, dtype, update_func, args)
+
+        kernels = specialize(update_func, ESCAPE_KERNELS, dtype)
+        lattice, saved = kernels._julia_kernel(complex(c), xvals, yvals, args, maxiter, kernel_horizon, log_smooth, period_tol)
+        _shift_smoothing(lattice, horizon, kernel_horizon, log_smooth)
+
+        if stats is not None:
+            stats['iterations_saved'] = saved
+
+    if antialias > 1:
+        _antialias(lattice, c, True, xbound, ybound, update_func, args, width, height, dpi, maxiter, horizon, log_smooth, antialias, aa_threshold, stats)
 
     return (lattice, width, height, dpi)
 
-def julia_series(c_vals, xbound, ybound, update_func, args=2, width=5, height=5, dpi=100, maxiter=100, horizon=2.0**40, log_smooth=True):
+def julia_series(c_vals, xbound, ybound, update_func, args=2, width=5, height=5, dpi=100, maxiter=100, horizon=2.0**40, log_smooth=True, interior=False, method='brute',
+                 incremental=False, block=8, stats=None, verify=False, tol=1e-6):
 
     """
-        produces a series of Julia arrays (one for each c_val in c_vals), can be used to make an animation
+        produces a series of Julia arrays (one for each c_val in c_vals), can be used to make an animation,
+        the kernel is compiled (or loaded from the cache) once and shared by all frames
+
+        incremental=True uses each frame as a guide for the next (see _julia_incremental_kernel), which pays off when
+        the c_vals are close together (with interior=True periodicity checking is only used where the previous frame
+        was interior), if a dict is passed as stats it gets lists (one entry per frame) of
+        'pixels_computed' and 'pixels_saved', verify=True also computes every frame in full and adds the
+        'max_error' and 'pixels_mismatched' (differing by more than tol) of each incremental frame, incremental frames
+        match the full ones only for connected sets (see _julia_incremental_kernel), block=2 fills no blocks (for e.g. magnetic_1)
     """
 
+    if not incremental:
+        return [julia(c, xbound, ybound, update_func, args=args, width=width, height=height, dpi=dpi, maxiter=maxiter, horizon=horizon, log_smooth=log_smooth, interior=interior, method=method)
+                for c in c_vals]
+
+    xvals, yvals = grid(xbound, ybound, width=width, height=height, dpi=dpi)
+    period_tol = _period_tol(xbound, ybound, width, height, dpi) if interior else 0.0
+    kernels = specialize(update_func, ESCAPE_KERNELS)
+
+    if stats is not None:
+        for key in ('pixels_computed', 'pixels_saved') + (('max_error', 'pixels_mismatched') if verify else ()):
+            stats[key] = []
+
     series = []
-    
+    prev = None
+
     for c in c_vals:
-        l = julia(c, xbound, ybound, update_func, args=args, width=width, height=height, dpi=dpi, maxiter=maxiter, horizon=horizon, log_smooth=log_smooth)
-        series.append(l)
+
+        if prev is None:
+            lattice = kernels._julia_kernel(complex(c), xvals, yvals, args, maxiter, horizon, log_smooth, period_tol)[0]
+            computed = lattice.size
+        else:
+            lattice, computed = kernels._julia_incremental_kernel(complex(c), xvals, yvals, prev, args, maxiter, horizon, log_smooth, period_tol, block)
+
+        if stats is not None:
+            stats['pixels_computed'].append(computed)
+            stats['pixels_saved'].append(lattice.size - computed)
+
+            if verify:
+                error = np.abs(lattice - kernels._julia_kernel(complex(c), xvals, yvals, args, maxiter, horizon, log_smooth, 0.0)[0])
+                stats['max_error'].append(float(error.max()))
+                stats['pixels_mismatched'].append(int((error > tol).sum()))
+
+        series.append((lattice, width, height, dpi))
+        prev = lattice
 
     return series
 
+def escape_state(xbound, ybound, update_func, c=None, args=2, width=5, height=5, dpi=100, maxiter=100, horizon=2.0**40, log_smooth=True):
+
+    """
+        a resumable Mandelbrot (or Julia, if c is given) render, returns a state dict holding the lattice tuple and,
+        for only the pixels that have not escaped, their flat indices and current iterates, refine(state, maxiter)
+        continues those pixels to a higher maxiter (for z**2 + c the main cardioid and period-2 bulb are dropped
+        from the survivors as they never escape)
+    """
+
+    xvals, yvals = grid(xbound, ybound, width=width, height=height, dpi=dpi)
+    is_julia = c is not None
+
+    X, Y = np.meshgrid(xvals, yvals, indexing='ij')
+    z = (X + 1j*Y).ravel()
+    idx = np.arange(len(z), dtype=np.int64)
+
+    if not is_julia and update_func is power and args == 2:
+        q = (z.real - 0.25)**2 + z.imag**2
+        keep = ~((q*(q + z.real - 0.25) <= 0.25*z.imag**2) | ((z.real + 1.0)**2 + z.imag**2 <= 0.0625))
+        idx, z = idx[keep], z[keep]
+
+    state = dict(lattice=(np.zeros((len(xvals), len(yvals)), dtype=np.float64), width, height, dpi), idx=idx, z=z, maxiter=0,
+                 xbound=xbound, ybound=ybound, update_func=update_func, c=None if c is None else complex(c), args=args, horizon=horizon, log_smooth=log_smooth)
+    refine(state, maxiter)
+
+    return state
+
+def refine(state, maxiter):
+
+    """
+        continues a state from escape_state to a higher maxiter, iterating only the surviving pixels, the state is
+        updated in place and its lattice (identical to a fresh render at maxiter) is returned
+    """
+
+    if maxiter < state['maxiter']:
+        raise ValueError('refine can only raise maxiter')
+
+    lattice, width, height, dpi = state['lattice']
+    xvals, yvals = grid(state['xbound'], state['ybound'], width=width, height=height, dpi=dpi)
+    idx, z = state['idx'], state['z']
+    c = state['c']
+
+    values = np.zeros(len(idx), dtype=np.float64)
+    escaped = np.zeros(len(idx), dtype=np.bool_)
+
+    kernels = specialize(state['update_func'], ESCAPE_KERNELS)
+    kernels._resume_kernel(idx, z, xvals, yvals, 0j if c is None else c, c is not None, state['args'], state['maxiter'], maxiter, state['horizon'], state['log_smooth'], values, escaped)
+
+    lattice.ravel()[idx[escaped]] = values[escaped]
+    state['idx'] = idx[~escaped]
+    state['z'] = z[~escaped]
+    state['maxiter'] = maxiter
+
+    return state['lattice']
+
+def save_state(state, filename):
+
+    """
+        saves a state from escape_state (as a .npz), the update function is stored by name
+    """
+
+    params = dict((k, v) for k, v in state.items() if k not in ('lattice', 'idx', 'z', 'c', 'update_func'))
+    params.update(update_func=state['update_func'].__name__, size=state['lattice'][1:])
+    c = np.array([] if state['c'] is None else [state['c']], dtype=np.complex128)
+
+    with open(filename + '.tmp', 'wb') as f:
+        np.savez(f, lattice=state['lattice'][0], idx=state['idx'], z=state['z'], c=c, params=json.dumps(params))
+
+    os.replace(filename + '.tmp', filename)
+
+def open_state(filename, update_func=None):
+
+    """
+        loads a state saved by save_state, update_func is looked up by name in UPDATE_FUNCS unless it is given
+    """
+
+    with np.load(filename) as data:
+
+        params = json.loads(str(data['params']))
+        width, height, dpi = params.pop('size')
+        name = params.pop('update_func')
+        state = dict(lattice=(data['lattice'], width, height, dpi), idx=data['idx'], z=data['z'], c=complex(data['c'][0]) if len(data['c']) else None,
+                     update_func=UPDATE_FUNCS[name] if update_func is None else update_func, **params)
+
+    return state
+
+def _julia_frame(job):
+
+    c, xbound, ybound, update_func, kwargs, threads, transform = job
+
+    if threads is not None:
+        set_num_threads(threads)
+
+    l = julia(c, xbound, ybound, update_func, **kwargs)
+
+    return l if transform is None else transform(l)
+
+def julia_frames(c_vals, xbound, ybound, update_func, args=2, width=5, height=5, dpi=100, maxiter=100, horizon=2.0**40, log_smooth=True, interior=False, method='brute',
+                 transform=None, backend='threads', workers=None, lookahead=None):
+
+    """
+        generator version of julia_series, yields the frames in order while at most lookahead of them are in flight,
+        so memory is bounded by the lookahead rather than the length of the series, transform (e.g. a partial of
+        image_creation.shade_frame) is applied to each frame by the worker that computed it
+
+        with backend='threads' the frames are computed ahead by workers background threads (default 1, running the
+        parallel kernel on all of the threads), with backend='processes' they are spread over a pool of workers processes
+        (default the kernel thread count), in both cases each worker runs the kernel on its share of the threads,
+        several threads need a threadsafe numba threading layer (tbb or omp), under workqueue a warning is given and
+        a single thread is used
+    """
+
+    kwargs = dict(args=args, width=width, height=height, dpi=dpi, maxiter=maxiter, horizon=horizon, log_smooth=log_smooth, interior=interior, method=method)
+
+    if backend == 'threads':
+        workers = 1 if workers is None else int(workers)
+        if workers > 1 and not threadsafe_layer():
+            warnings.warn('the workqueue threading layer is not threadsafe, computing the frames on one thread (install tbb or use '
+                          'backend=\'processes\')', stacklevel=2)
+            workers = 1
+        threads = None if workers == 1 else max(1, get_num_threads()//workers)
+        pool = ThreadPoolExecutor(max_workers=workers)
+    elif backend == 'processes':
+        workers = get_num_threads() if workers is None else int(workers)
+        threads = max(1, get_num_threads()//workers)
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'))
+    else:
+        raise ValueError('backend must be threads or processes')
+
+    lookahead = 2*workers if lookahead is None else max(1, int(lookahead))
+    pending = deque()
+
+    with pool:
+        for c in c_vals:
+            pending.append(pool.submit(_julia_frame, (c, xbound, ybound, update_func, kwargs, threads, transform)))
+            if len(pending) >= lookahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
 if __name__ == '__main__':
 
     pass
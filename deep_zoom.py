@@ -0,0 +1,166 @@
+import numpy as np
+from numpy import log
+from decimal import Decimal, localcontext
+from numba import njit, prange
+from grid import axis_values
+
+try:
+    import mpmath
+except ImportError:
+    mpmath = None
+
+# deep zooms of the z**2 + c Mandelbrot set by perturbation theory, one reference orbit W is computed in high precision
+# at the center of the view and every pixel iterates only its (float64) difference from it, d -> 2*W*d + d**2 + dc
+# the orbits here start from 0 (W_0 = 0) which is one step behind the z = c start of complex_dynamics.mandelbrot
+
+def _to_decimal(v):
+
+    return v if isinstance(v, Decimal) else Decimal(str(v)) if isinstance(v, str) else Decimal(v)
+
+def reference_orbit(cx, cy, maxiter, horizon, digits):
+
+    """
+        the orbit of cx + i*cy (Decimals) under z**2 + c starting from 0, computed with digits significant digits
+        (using mpmath if it is installed) and rounded to complex128, the orbit stops once it escapes horizon
+    """
+
+    orbit = np.zeros(maxiter + 2, dtype=np.complex128)
+
+    if mpmath is not None:
+
+        with mpmath.workdps(digits):
+            c = mpmath.mpc(mpmath.mpf(str(cx)), mpmath.mpf(str(cy)))
+            z = mpmath.mpc(0)
+            for n in range(1, maxiter + 2):
+                z = z*z + c
+                orbit[n] = complex(z)
+                if abs(orbit[n]) > horizon:
+                    return orbit[:n + 1]
+
+    else:
+
+        with localcontext() as ctx:
+            ctx.prec = digits
+            x = y = Decimal(0)
+            for n in range(1, maxiter + 2):
+                x, y = x*x - y*y + cx, 2*x*y + cy
+                orbit[n] = complex(float(x), float(y))
+                if abs(orbit[n]) > horizon:
+                    return orbit[:n + 1]
+
+    return orbit
+
+@njit(cache=True, nogil=True)
+def series_skip(orbit, radius, maxiter, series_tol):
+
+    """
+        the number of iterations that can be skipped with the series approximation d_n = A_n*dc + B_n*dc**2 + C_n*dc**3,
+        valid (for |dc| <= radius) while the cubic term is within series_tol of the linear one, returns n, A_n, B_n, C_n
+    """
+
+    A = 0j
+    B = 0j
+    C = 0j
+    n = 0
+
+    while n + 1 < min(len(orbit) - 1, maxiter):
+
+        W = orbit[n]
+        An = 2*W*A + 1
+        Bn = 2*W*B + A*A
+        Cn = 2*W*C + 2*A*B
+
+        if abs(Cn)*radius**3 > series_tol*abs(An)*radius:
+            break
+
+        A, B, C = An, Bn, Cn
+        n += 1
+
+    return n, A, B, C
+
+@njit(cache=True, nogil=True)
+def _perturbed_escape(dc, orbit, skip, A, B, C, maxiter, horizon, log_horizon, log_smooth):
+
+    """
+        iterates one pixel (dc from the reference) by perturbation, the reference is rebased to its start whenever
+        |z| < |d| (where the float64 difference would lose all of its precision, a "glitch") or the reference has
+        escaped, returns the value and the number of rebases
+    """
+
+    d = A*dc + B*dc*dc + C*dc*dc*dc
+    m = skip
+    rebases = 0
+
+    for k in range(skip, maxiter + 1):
+
+        z = orbit[m] + d
+        az = abs(z)
+
+        if k > 0 and az > horizon:
+            if log_smooth:
+                return (k - 1) - log(log(az))/log(2) + log_horizon, rebases
+            return k - 1, rebases
+
+        if az < abs(d) or m == len(orbit) - 1:
+            d = z
+            m = 0
+            rebases += 1
+
+        d = 2*orbit[m]*d + d*d + dc
+        m += 1
+
+    return 0.0, rebases
+
+@njit(cache=True, parallel=True)
+def _deep_mandelbrot_kernel(dxvals, dyvals, orbit, skip, A, B, C, maxiter, horizon, log_smooth):
+
+    lattice = np.zeros((len(dxvals), len(dyvals)), dtype=np.float64)
+    log_horizon = log(log(horizon))/log(2)
+    rebases = 0
+
+    for i in prange(len(dxvals)):
+        for j in range(len(dyvals)):
+            value, r = _perturbed_escape(dxvals[i] + 1j*dyvals[j], orbit, skip, A, B, C, maxiter, horizon, log_horizon, log_smooth)
+            lattice[i,j] = value
+            rebases += r
+
+    return lattice, rebases
+
+def deep_mandelbrot(xbound, ybound, width=5, height=5, dpi=100, maxiter=1000, horizon=2.0**40, log_smooth=True, series_tol=1e-6, stats=None):
+
+    """
+        function for producing Mandelbrot (z**2 + c) arrays at zooms beyond float64 precision, the bounds can be given as
+        strings or Decimals (e.g. the NOTES.txt regions) so that they are not rounded to float64, returns the same
+        (lattice, width, height, dpi) tuple as complex_dynamics.mandelbrot
+
+        one reference orbit is computed in high precision at the center of the view and every pixel is iterated as a
+        float64 difference from it, the first iterations are skipped with a series approximation (series_tol sets its
+        accuracy) and glitches are avoided by rebasing, stats (a dict) gets 'series_skipped' and 'rebases'
+    """
+
+    xmin, xmax = [_to_decimal(b) for b in xbound]
+    ymin, ymax = [_to_decimal(b) for b in ybound]
+    nx = int(width*dpi)
+    ny = int(height*dpi)
+
+    span = max(abs(xmax - xmin), abs(ymax - ymin))
+    digits = max(30, 20 - int(span.log10()))
+
+    with localcontext() as ctx:
+        ctx.prec = digits
+        cx = (xmin + xmax)/2
+        cy = (ymin + ymax)/2
+        dxvals = axis_values(float(xmin - cx), float(xmax - cx), nx)
+        dyvals = axis_values(float(ymin - cy), float(ymax - cy), ny)
+
+    orbit = reference_orbit(cx, cy, maxiter, horizon, digits)
+    radius = float(np.hypot(np.abs(dxvals).max(), np.abs(dyvals).max()))
+    skip, A, B, C = series_skip(orbit, radius, maxiter, series_tol)
+
+    lattice, rebases = _deep_mandelbrot_kernel(dxvals, dyvals, orbit, skip, A, B, C, maxiter, horizon, log_smooth)
+
+    if stats is not None:
+        stats['series_skipped'] = skip
+        stats['rebases'] = rebases
+
+    return (lattice, width, height, dpi)
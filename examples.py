@@ -1,12 +1,15 @@
 import numpy as np
 import time
+from decimal import Decimal
 import matplotlib.colors as mcolors
 from matplotlib import pyplot as plt
-from complex_dynamics import mandelbrot, julia, julia_series, power, cosine, magnetic_1, magnetic_2
+from functools import partial
+from complex_dynamics import mandelbrot, julia, julia_frames, power, cosine, magnetic_1, magnetic_2
 from random_walks import construct_moves, random_walk_3D
-from buddhabrot import compute_cvals, buddhabrot
+from buddhabrot import compute_cvals, buddhabrot_channels
 from lyapunov import lyapunov
-from image_creation import image, save_image_array, random_walk_3D_image, nebula_image, stack_cmaps, animate
+from deep_zoom import deep_mandelbrot
+from image_creation import image, save_image_array, random_walk_3D_image, nebula_image, stack_cmaps, shade_frame, write_gif
 
 pi = np.pi 
 
@@ -71,6 +74,20 @@ def mandelbrot_ex3(): # zoomed in on a mini-Mandel, stacked colormaps look good
 
     print('calculation took %s seconds ' % np.round((time.time() - start_time), 3))
 
+def deep_zoom_ex(): # far beyond float64 precision, the bounds are given as strings so that they are not rounded
+
+    cx = Decimal('0.3602404434376143632361252444495')
+    cy = Decimal('-0.6413130610648031748603750151793')
+    h = Decimal('1.5e-25')
+
+    start_time = time.time()
+    mymap = stack_cmaps(plt.cm.gist_gray, 20)
+
+    man = deep_mandelbrot((cx - h, cx + h), (cy - h*2/3, cy + h*2/3), width=4, height=3, maxiter=20000, dpi=300)
+    image(man, cmap=mymap, filename='deep_zoom_ex', gamma=0.8)
+
+    print('calculation took %s seconds ' % np.round((time.time() - start_time), 3))
+
 # ----- Julia images ----- #
 
 def julia_ex0():
@@ -145,8 +162,9 @@ def julia_animation_ex():
     start_time = time.time()
 
     c_vals = np.array([complex(i,0.75) for i in np.linspace(0.05, 3.0, 100)])
-    s = julia_series(c_vals, [-1,1], [-0.75,1.25], magnetic_2, args=2, maxiter=100, width=4, height=3)
-    animate(s, gamma=0.9, cmap=plt.cm.gist_ncar, filename='julia_animation_ex')
+    shade = partial(shade_frame, gamma=0.9, cmap=plt.cm.gist_ncar)
+    frames = julia_frames(c_vals, [-1,1], [-0.75,1.25], magnetic_2, args=2, maxiter=100, width=4, height=3, transform=shade, backend='processes')
+    write_gif(frames, filename='julia_animation_ex')
 
     print('calculation took %s seconds ' % np.round((time.time() - start_time), 3))
 
@@ -159,7 +177,7 @@ def lyapunov_ex():
     yB = (2.45, 4.0)
 
     im = lyapunov(string, xB, yB, maxiter=80, dpi=300, width=4, height=3)
-    image(im, gamma=3.0, vert_exag=10000.0, filename='lyapunov_ex', cmap=plt.cm.gray)
+    image(im, gamma=3.0, vert_exag=800000.0, filename='lyapunov_ex', cmap=plt.cm.gray)
 
 # ----- random walk image -----#
 
@@ -182,9 +200,7 @@ def buddhabrot_ex():
 
     cvals = compute_cvals(1000000, xB, yB, power, args=2, width=4, height=3, dpi=300)
 
-    bud0 = buddhabrot(xB, yB, cvals, power, args=2, horizon=1.0E6, maxiter=100, width=5, height=4, dpi=300)
-    bud1 = buddhabrot(xB, yB, cvals, power, args=2, horizon=1.0E6, maxiter=1000, width=5, height=4, dpi=300)    
-    bud2 = buddhabrot(xB, yB, cvals, power, args=2, horizon=1.0E6, maxiter=10000, width=5, height=4, dpi=300)
+    bud0, bud1, bud2 = buddhabrot_channels(xB, yB, cvals, power, args=2, horizon=1.0E6, maxiters=(100,1000,10000), width=5, height=4, dpi=300)
     
     nebula_image(bud0, bud1, bud2, gamma=0.4, filename='buddhabrot_ex', image_type='png')
 
@@ -0,0 +1,99 @@
+import warnings
+import numpy as np
+from numba import njit
+
+# the viewport shared by all of the fractal functions, a lattice of nx = width*dpi by ny = height*dpi pixels
+# covering xbound x ybound, pixel i spans [lo + i*(hi - lo)/n, lo + (i+1)*(hi - lo)/n)
+
+def viewport(xbound, ybound, width=5, height=5, dpi=100):
+
+    """
+        returns xmin, xmax, ymin, ymax, nx, ny for the given bounds and image size
+    """
+
+    xmin,xmax = [float(xbound[0]),float(xbound[1])]
+    ymin,ymax = [float(ybound[0]),float(ybound[1])]
+
+    return xmin, xmax, ymin, ymax, int(width*dpi), int(height*dpi)
+
+def axis_edges(lo, hi, n, dtype=np.float64):
+
+    """
+        the n + 1 pixel edges spanning [lo, hi], computed in place (no intermediate arrays)
+    """
+
+    edges = np.arange(n + 1, dtype=np.float64)
+    edges *= (hi - lo)
+    edges /= n
+    edges += lo
+    edges[-1] = hi
+
+    return edges.astype(dtype, copy=False)
+
+def axis_values(lo, hi, n, dtype=np.float64):
+
+    """
+        the lower edge of each of the n pixels spanning [lo, hi)
+    """
+
+    return axis_edges(lo, hi, n, dtype=dtype)[:-1]
+
+def grid(xbound, ybound, width=5, height=5, dpi=100, dtype=np.float64):
+
+    """
+        returns the xvals and yvals (real and imaginary parts) of the pixels in the viewport
+    """
+
+    xmin, xmax, ymin, ymax, nx, ny = viewport(xbound, ybound, width=width, height=height, dpi=dpi)
+
+    return axis_values(xmin, xmax, nx, dtype=dtype), axis_values(ymin, ymax, ny, dtype=dtype)
+
+# single precision is only used while a pixel spans at least this fraction of the coordinates' magnitude (about
+# 128 float32 ulps), below it neighboring pixels start to round to the same values
+
+SINGLE_PRECISION_LIMIT = 2.0**-16
+
+def precision_dtype(precision, xbound, ybound, width=5, height=5, dpi=100):
+
+    """
+        the float dtype for precision ('double' or 'single'), single precision falls back to double (with a
+        warning) when the pixel spacing of the viewport is too close to float32 resolution
+    """
+
+    if precision == 'double':
+        return np.float64
+    if precision != 'single':
+        raise ValueError('precision must be double or single')
+
+    xmin, xmax, ymin, ymax, nx, ny = viewport(xbound, ybound, width=width, height=height, dpi=dpi)
+    spacing = min((xmax - xmin)/nx, (ymax - ymin)/ny)
+    scale = max(abs(xmin), abs(xmax), abs(ymin), abs(ymax), 1.0)
+
+    if spacing < SINGLE_PRECISION_LIMIT*scale:
+        warnings.warn('pixel spacing %.3g is too fine for single precision, using double precision' % spacing, stacklevel=3)
+        return np.float64
+
+    return np.float32
+
+@njit(cache=True, nogil=True)
+def pixel_coordinate(i, lo, hi, n):
+
+    """
+        the coordinate of the lower edge of pixel i
+    """
+
+    return lo + i*(hi - lo)/n
+
+@njit(cache=True, nogil=True)
+def pixel_index(v, lo, hi, n):
+
+    """
+        the index of the pixel containing coordinate v, -1 if v is outside of [lo, hi)
+    """
+
+    if not lo <= v < hi:
+        return -1
+
+    i = int((v - lo)*n/(hi - lo))
+
+    return min(i, n - 1)
@@ -4,21 +4,30 @@ matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 from skimage.restoration import denoise_nl_means, estimate_sigma
 from matplotlib import colors
-from numpy.ma import masked_where
 import matplotlib.colors as mcolors
-import matplotlib.animation as animation
-import pickle
+import zlib
+import struct
+from PIL import Image, GifImagePlugin
+from numba import njit, prange
+from lattice_io import save_lattice, open_lattice
+from sparse_lattice import ChunkedLattice
 
-def save_image_array(A, name='save'):
+def save_image_array(A, name='save', compress=False, **meta):
 
-    with open(name + '.pkl','wb') as f:
-        pickle.dump(A, f)
+    """
+        saves a (lattice, width, height, dpi) tuple as name.lattice (see lattice_io), metadata such as bounds,
+        maxiter, update_func and seed can be passed as keywords
+    """
 
-def open_image_array(file):
+    save_lattice(A, name + '.lattice', compress=compress, **meta)
 
-    with open(file,'rb') as f:
-        A = pickle.load(f)
-        return A
+def open_image_array(file, mmap_mode=None):
+
+    """
+        opens a file written by save_image_array, mmap_mode='r' maps the lattice instead of reading it into memory
+    """
+
+    return open_lattice(file, mmap_mode=mmap_mode)
 
 def stack_cmaps(cmap, Nstacks):
     
@@ -31,11 +40,239 @@ def stack_cmaps(cmap, Nstacks):
 
     return mymap
 
-def image(lattice, cmap=plt.cm.hot, filename='f', image_type='png', ticks='off', gamma=0.3, vert_exag=0, ls=[315,10]):
+def power_norm(A, gamma, vmin, vmax):
+
+    """
+        array version of matplotlib's PowerNorm, maps [vmin, vmax] to [0, 1] and applies the gamma, everything maps
+        to 0 if vmax <= vmin and non-finite values of A are returned as nan (colored with the bad color)
+    """
+
+    if not vmax > vmin:
+        return np.where(np.isfinite(A), 0.0, np.nan)
+
+    M = np.clip((A - vmin)/(vmax - vmin), 0.0, 1.0)
+    M[~np.isfinite(A)] = np.nan
+
+    return M**gamma
+
+def finite_range(A):
+
+    """
+        the minimum and maximum of the finite values of A (0, 0 if there are none), as imshow autoscales
+    """
+
+    finite = np.isfinite(A)
+    if finite.all():
+        return np.amin(A), np.amax(A)
+    if not finite.any():
+        return 0.0, 0.0
+
+    return np.amin(A[finite]), np.amax(A[finite])
+
+def colormap_lut(cmap, bytes=True):
+
+    """
+        the RGB lookup table of a colormap (including stack_cmaps output), entry k is the color matplotlib gives
+        normalized values in [k/N, (k+1)/N), as uint8 or (bytes=False) floats in [0, 1]
+    """
+
+    return cmap(np.arange(cmap.N), bytes=bytes)[:, :3]
+
+def bad_color(cmap, bytes=True):
+
+    """
+        the colormap's bad color (for non-finite values) as RGB over a white background, as it shows in a saved figure
+    """
+
+    rgba = np.array(cmap(np.nan))
+    rgb = rgba[:3]*rgba[3] + (1.0 - rgba[3])
+
+    return (rgb*255).round().astype(np.uint8) if bytes else rgb
+
+def _lut_index(M, N):
+
+    idx = (np.nan_to_num(M)*N).astype(np.intp)
+    np.minimum(idx, N - 1, out=idx)
+
+    return idx
+
+def _lut_colors(M, lut, bad):
+
+    rgb = lut[_lut_index(M, len(lut))]
+    rgb[np.isnan(M)] = bad
+
+    return rgb
+
+def colorize(A, cmap=plt.cm.hot, gamma=0.3, vmin=None, vmax=None):
+
+    """
+        colors an array with a PowerNorm and a colormap lookup table without matplotlib figures, returns uint8 RGB
+    """
+
+    if vmin is None or vmax is None:
+        lo, hi = finite_range(A)
+        vmin = lo if vmin is None else vmin
+        vmax = hi if vmax is None else vmax
+
+    return _lut_colors(power_norm(A, gamma, vmin, vmax), colormap_lut(cmap), bad_color(cmap))
+
+def hillshade(A, vert_exag=1.0, ls=[315,10]):
+
+    """
+        array version of LightSource.hillshade, the illumination intensity (in [0, 1]) of the surface A lit from
+        azimuth ls[0] and altitude ls[1] (degrees), rows of A are taken from the top of the image down
+    """
+
+    az = np.radians(90 - ls[0])
+    alt = np.radians(ls[1])
+
+    e_dy, e_dx = np.gradient(vert_exag*A, -1, 1)
+    intensity = (np.sin(alt) - e_dx*np.cos(az)*np.cos(alt) - e_dy*np.sin(az)*np.cos(alt))/np.sqrt(e_dx*e_dx + e_dy*e_dy + 1.0)
+
+    imin, imax = intensity.min(), intensity.max()
+    if imax - imin > 1e-6:
+        intensity -= imin
+        intensity /= (imax - imin)
+
+    return np.clip(intensity, 0.0, 1.0, out=intensity)
+
+@njit(cache=True, parallel=True)
+def blend_hsv(rgb, intensity):
+
+    """
+        LightSource.blend_hsv (with the default saturation and value limits) fused into one pass, rgb is a float
+        array in [0, 1] and intensity a hillshade, returns uint8 RGB
+    """
+
+    out = np.empty(rgb.shape, dtype=np.uint8)
+
+    for i in prange(rgb.shape[0]):
+        for j in range(rgb.shape[1]):
+
+            r, g, b = rgb[i,j,0], rgb[i,j,1], rgb[i,j,2]
+            v = max(r, g, b)
+            delta = v - min(r, g, b)
+            s = delta/v if v > 0.0 else 0.0
+            h = 0.0
+
+            if delta > 0.0:
+                if b == v:
+                    h = 4.0 + (r - g)/delta
+                elif g == v:
+                    h = 2.0 + (b - r)/delta
+                else:
+                    h = (g - b)/delta
+                h = (h/6.0) % 1.0
+
+            I = 2.0*intensity[i,j] - 1.0
+
+            if abs(s) > 1e-10:
+                if I > 0.0:
+                    s = (1.0 - I)*s
+                elif I < 0.0:
+                    s = (1.0 + I)*s - I
+            if I > 0.0:
+                v = (1.0 - I)*v + I
+            elif I < 0.0:
+                v = (1.0 + I)*v
+
+            s = min(max(s, 0.0), 1.0)
+            v = min(max(v, 0.0), 1.0)
+
+            k = int(h*6.0)
+            f = h*6.0 - k
+            p = v*(1.0 - s)
+            q = v*(1.0 - s*f)
+            t = v*(1.0 - s*(1.0 - f))
+            k = k % 6
+
+            if s == 0.0:
+                r, g, b = v, v, v
+            elif k == 0:
+                r, g, b = v, t, p
+            elif k == 1:
+                r, g, b = q, v, p
+            elif k == 2:
+                r, g, b = p, v, t
+            elif k == 3:
+                r, g, b = p, q, v
+            elif k == 4:
+                r, g, b = t, p, v
+            else:
+                r, g, b = v, p, q
+
+            out[i,j,0] = int(r*255.0)
+            out[i,j,1] = int(g*255.0)
+            out[i,j,2] = int(b*255.0)
+
+    return out
+
+def shade(A, cmap=plt.cm.hot, gamma=0.3, vert_exag=0, ls=[315,10]):
+
+    """
+        the hsv-blended hillshade of LightSource.shade with a PowerNorm, as array operations, returns uint8 RGB
+    """
+
+    vmin, vmax = finite_range(A)
+    rgb = _lut_colors(power_norm(A, gamma, vmin, vmax), colormap_lut(cmap, bytes=False), bad_color(cmap, bytes=False))
+    A = np.where(np.isfinite(A), A, vmin)
+
+    return blend_hsv(rgb, hillshade(A, vert_exag=vert_exag, ls=ls))
+
+def save_rgb(M, filename='f', image_type='png'):
+
+    """
+        saves a uint8 RGB array (top row first), PNGs are written directly and other formats through PIL
+    """
+
+    if image_type == 'png':
+        write_png(filename + '.png', [M], M.shape[1], M.shape[0])
+    else:
+        Image.fromarray(M).save(filename + '.' + image_type)
+
+def _png_chunk(f, tag, data):
+
+    f.write(struct.pack('>I', len(data)) + tag + data)
+    f.write(struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+def write_png(filename, blocks, nx, ny, level=6):
+
+    """
+        writes an 8-bit RGB PNG of nx by ny pixels one block of rows at a time, blocks is an iterable of uint8 arrays
+        of shape (rows, nx, 3) ordered from the top of the image, so the image never has to be held in memory
+    """
+
+    with open(filename, 'wb') as f:
+
+        f.write(b'\x89PNG\r\n\x1a\n')
+        _png_chunk(f, b'IHDR', struct.pack('>IIBBBBB', nx, ny, 8, 2, 0, 0, 0))
+        compressor = zlib.compressobj(level)
+
+        for block in blocks:
+            rows = np.zeros((block.shape[0], 3*nx + 1), dtype=np.uint8)
+            rows[:, 1:] = block.reshape(block.shape[0], 3*nx)
+            data = compressor.compress(rows.tobytes())
+            if data:
+                _png_chunk(f, b'IDAT', data)
+
+        _png_chunk(f, b'IDAT', compressor.flush())
+        _png_chunk(f, b'IEND', b'')
+
+def image(lattice, cmap=plt.cm.hot, filename='f', image_type='png', ticks='off', gamma=0.3, vert_exag=0, ls=[315,10], direct=False):
+
+    """
+        saves an image of a lattice colored with cmap and a PowerNorm (hillshaded if vert_exag != 0), direct=True
+        colors the array with shade/colorize and writes it straight to file instead of drawing a matplotlib figure
+    """
 
     A, width, height, dpi = lattice
     A = A.T
 
+    if direct:
+        M = shade(A, cmap=cmap, gamma=gamma, vert_exag=vert_exag, ls=ls) if vert_exag != 0.0 else colorize(A, cmap=cmap, gamma=gamma)
+        save_rgb(M[::-1], filename=filename, image_type=image_type)
+        return
+
     w,h = plt.figaspect(A)
     fig, ax0 = plt.subplots(figsize=(w,h), dpi=dpi)
     fig.subplots_adjust(0,0,1,1)
@@ -56,7 +293,7 @@ def image(lattice, cmap=plt.cm.hot, filename='f', image_type='png', ticks='off',
 
     fig.savefig(filename + '.' + image_type, dpi=dpi)
 
-def nebula_image(AB, AG, AR, filename='f', image_type='png', ticks='off', gamma=1.0, denoise=False):
+def nebula_image(AB, AG, AR, filename='f', image_type='png', ticks='off', gamma=1.0, denoise=False, direct=False):
 
     A_blue, width, height, dpi = AB
     A_green = AG[0]
@@ -70,11 +307,6 @@ def nebula_image(AB, AG, AR, filename='f', image_type='png', ticks='off', gamma=
     A_green /= np.amax(A_green)
     A_red /= np.amax(A_red)
 
-    w,h = plt.figaspect(A_blue)
-    fig, ax0 = plt.subplots(figsize=(w,h), dpi=dpi)
-    fig.subplots_adjust(0,0,1,1)
-    plt.axis(ticks)
-
     M = np.dstack((A_red, A_green, A_blue))
 
     if denoise:
@@ -82,38 +314,65 @@ def nebula_image(AB, AG, AR, filename='f', image_type='png', ticks='off', gamma=
         patch_kw = dict(patch_size=9, patch_distance=15, multichannel=True)
         M = denoise_nl_means(M, h=0.9*sigma_est, fast_mode=True, **patch_kw)
 
+    if direct:
+        save_rgb((np.clip(M**gamma, 0.0, 1.0)[::-1]*255).astype(np.uint8), filename=filename, image_type=image_type)
+        return
+
+    w,h = plt.figaspect(A_blue)
+    fig, ax0 = plt.subplots(figsize=(w,h), dpi=dpi)
+    fig.subplots_adjust(0,0,1,1)
+    plt.axis(ticks)
+
     ax0.imshow(M**gamma, origin='lower')
     F = plt.gcf()
     F.set_size_inches(width, height)
 
     fig.savefig(filename + '.' + image_type, dpi=dpi)
 
-def animate(series, fps=15, bitrate=1800, cmap=plt.cm.hot, filename='f', ticks='off', gamma=0.3, vert_exag=0, ls=[315,10]):
+def shade_frame(lattice, cmap=plt.cm.hot, gamma=0.3, vert_exag=0, ls=[315,10]):
 
-    writer = animation.PillowWriter(fps=fps, metadata=dict(artist='Me'), bitrate=bitrate)
+    """
+        the hsv-blended hillshade used by animate, computed directly on the array (no figure) and returned as a
+        uint8 RGB array with the top row of the image first
+    """
 
-    norm = colors.PowerNorm(gamma)
-    light = colors.LightSource(azdeg=ls[0], altdeg=ls[1])
+    return shade(lattice[0].T, cmap=cmap, gamma=gamma, vert_exag=vert_exag, ls=ls)[::-1]
 
-    foo, width, height, dpi = series[0]
-    FIG = plt.figure()
-    F = plt.gcf()
-    F.set_size_inches(width, height)
-    plt.axis(ticks)
-    ims = []
+def write_gif(frames, filename='f', fps=15, loop=0):
 
-    for s in series:
+    """
+        writes an animated GIF one frame at a time, frames is an iterable (e.g. a generator) of uint8 RGB arrays,
+        each frame is quantized with its own palette and only the current frame is held in memory
+    """
 
-        A, width, height, dpi = s
-        A = A.T
-        M = light.shade(A, cmap=cmap, norm=norm, vert_exag=vert_exag, blend_mode='hsv')
-        im = plt.imshow(M, origin='lower', norm=norm)
-        ims.append([im])
+    duration = int(1000/fps)
+    count = 0
 
-    ani = animation.ArtistAnimation(FIG, ims, interval=50, blit=True, repeat_delay=1000)
-    ani.save(filename + '.gif', dpi=dpi, writer=writer)
+    with open(filename + '.gif', 'wb') as f:
 
-def markus_lyapunov_image(M, gammas=(1.0, 1.0, 1.0), ticks='off', filename='f', image_type='png', ls=[315,10], vert_exag=0.0):
+        for frame in frames:
+            im = Image.fromarray(frame).quantize(256)
+            if count == 0:
+                header, used = GifImagePlugin.getheader(im, info={'loop':loop, 'duration':duration})
+                f.write(b''.join(header))
+            for data in GifImagePlugin.getdata(im, duration=duration, include_color_table=True):
+                f.write(data)
+            count += 1
+
+        f.write(b';')
+
+    return count
+
+def animate(series, fps=15, bitrate=1800, cmap=plt.cm.hot, filename='f', ticks='off', gamma=0.3, vert_exag=0, ls=[315,10]):
+
+    """
+        makes a GIF from a series (any iterable, e.g. complex_dynamics.julia_frames) of lattices, the frames are
+        shaded and written one at a time
+    """
+
+    write_gif((shade_frame(s, cmap=cmap, gamma=gamma, vert_exag=vert_exag, ls=ls) for s in series), filename=filename, fps=fps)
+
+def markus_lyapunov_image(M, gammas=(1.0, 1.0, 1.0), ticks='off', filename='f', image_type='png', ls=[315,10], vert_exag=0.0, direct=False):
 
     A, width, height, dpi = M
     rg, gg, bg = gammas 
@@ -132,6 +391,12 @@ def markus_lyapunov_image(M, gammas=(1.0, 1.0, 1.0), ticks='off', filename='f',
     blue /= np.amax(blue)
     blue = blue ** bg
 
+    if direct:
+        M = np.dstack((red, green, blue))
+        M = blend_hsv(M, hillshade(A, vert_exag=vert_exag, ls=ls)) if vert_exag != 0.0 else (np.clip(M, 0.0, 1.0)*255).astype(np.uint8)
+        save_rgb(M[::-1], filename=filename, image_type=image_type)
+        return
+
     w,h = plt.figaspect(blue)
     fig, ax0 = plt.subplots(figsize=(width,height), dpi=dpi)
     fig.subplots_adjust(0,0,1,1)
@@ -157,38 +422,59 @@ def markus_lyapunov_image(M, gammas=(1.0, 1.0, 1.0), ticks='off', filename='f',
 
 def random_walk_3D_image(lattice, cmap=plt.cm.hot, single_color=False, filename='f', image_type='png', ticks='off', gamma=0.3, vert_exag=0, ls=[315,10], alpha_scale=1.0):
 
+    """
+        composites the depth slices of a 3D random walk lattice (an array or a sparse_lattice.ChunkedLattice) over a
+        white background, slice i has opacity (1 - (i + 1)/(depth + 1))*alpha_scale and is drawn over the slices
+        before it, empty cells are transparent, each slice is colored with cmap and its own PowerNorm (or hillshaded
+        with an overlay blend if vert_exag != 0)
+
+        the slices are composited front to back one at a time as array operations (stopping once nothing behind
+        can show through), so only one slice is ever dense in memory
+    """
+
     A, width, height, dpi = lattice
+    depth = A.shape[-1]
 
-    if single_color:
-        A[np.nonzero(A)] = 1.0
+    # a ChunkedLattice holds raw counts, its slices are normalized as random_walk_3D normalizes a dense lattice
+    # (hillshade depends on the scale)
+    scale = np.float32(A.amax()) if isinstance(A, ChunkedLattice) else None
 
-    w,h = plt.figaspect(A[:,:,0])
-    fig, ax0 = plt.subplots(figsize=(w,h), dpi=dpi)
-    fig.subplots_adjust(0,0,1,1)
-    plt.axis(ticks)
+    lut = colormap_lut(cmap, bytes=False)
+    color = np.zeros(A.shape[:2] + (3,), dtype=np.float64)
+    transmit = np.ones(A.shape[:2], dtype=np.float64)
 
-    max_ind = float(A.shape[-1] + 1)
+    for i in reversed(range(depth)):
 
-    for i in range(A.shape[-1]):
-        
-        IM = A[..., i]
-        IM = masked_where(IM == 0, IM)
+        IM = A[:, :, i] if scale is None else A[:, :, i].astype(np.float32)/scale
+        IM = np.asarray(IM, dtype=np.float64)
+        if single_color:
+            IM = (IM != 0).astype(np.float64)
 
-        alpha = 1 - (i + 1)/max_ind
-        alpha *= alpha_scale
+        mask = IM != 0
+        if not mask.any():
+            continue
 
-        norm = colors.PowerNorm(gamma)
-        light = colors.LightSource(azdeg=ls[0], altdeg=ls[1])
+        vmin, vmax = IM[mask].min(), IM[mask].max()
 
         if vert_exag != 0.0:
-            M = light.shade(IM, cmap=cmap, vert_exag=vert_exag, blend_mode='overlay')
-            ax0.imshow(M, origin='lower', alpha=alpha, interpolation=None)
-        else: 
-            M = IM
-            ax0.imshow(M, origin='lower', alpha=alpha, cmap=cmap, norm=norm, interpolation=None)
-        
-    F = plt.gcf()
-    F.set_size_inches(width, height)
-        
-    fig.savefig(filename + '.' + image_type, dpi=dpi)
-
+            M = (IM - vmin)/(vmax - vmin) if vmax > vmin else np.zeros_like(IM)
+            rgb = lut[_lut_index(np.clip(M, 0.0, 1.0), len(lut))]
+            intensity = hillshade(np.ma.masked_where(~mask, IM), vert_exag=vert_exag, ls=ls)
+            shaded = ~np.ma.getmaskarray(intensity)
+            intensity = np.ma.getdata(intensity)[..., np.newaxis]
+            rgb = np.where(shaded[..., np.newaxis], np.where(rgb <= 0.5, 2*intensity*rgb, 1 - 2*(1 - intensity)*(1 - rgb)), rgb)
+        else:
+            M = power_norm(IM, gamma, vmin, vmax) if vmax > vmin else np.zeros_like(IM)
+            rgb = lut[_lut_index(M, len(lut))]
+
+        alpha = (1 - (i + 1)/float(depth + 1))*alpha_scale*mask
+        color += (transmit*alpha)[..., np.newaxis]*rgb
+        transmit *= 1 - alpha
+
+        if transmit.max() < 1.0/512:
+            break
+
+    color += transmit[..., np.newaxis]
+    M = (np.clip(color, 0.0, 1.0)*255).round().astype(np.uint8)
+
+    save_rgb(M[::-1], filename=filename, image_type=image_type)
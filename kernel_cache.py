@@ -0,0 +1,167 @@
+import os
+import sys
+import hashlib
+import inspect
+import tempfile
+import textwrap
+from types import ModuleType, CodeType
+import numpy as np
+import numba
+from numba import njit
+from numba.core.registry import CPUDispatcher
+
+# kernels are written once as plain Python "templates" that call a global named update_func and use the
+# global FLOAT/COMPLEX dtypes, specialize() binds those globals and compiles a parallel nopython version
+# the generated source is written to a cache directory so that numba's on-disk cache is hit across runs
+
+CACHE_DIR = os.environ.get('FRACTAL_KERNEL_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'pythonfractals', 'kernels'))
+
+DTYPES = {
+    'float64'  : (np.float64, np.complex128),
+    'float32'  : (np.float32, np.complex64),
+}
+
+_kernels = {}
+
+def kernel(parallel=False):
+
+    """
+        marks a function as a kernel template, the function itself is left untouched (it is only ever run
+        after specialization), parallel=True should be used for templates containing a prange loop
+    """
+
+    def mark(func):
+        func.parallel = parallel
+        return func
+
+    return mark
+
+def set_num_threads(n):
+
+    """
+        sets the number of threads used by the parallel kernels (at most NUMBA_NUM_THREADS)
+    """
+
+    numba.set_num_threads(max(1, min(int(n), numba.config.NUMBA_NUM_THREADS)))
+
+def get_num_threads():
+
+    return numba.get_num_threads()
+
+def threadsafe_layer():
+
+    """
+        whether the threading layer the parallel kernels run on (tbb, omp or workqueue, launched here if it has not
+        been yet) allows them to be called from several threads at once, workqueue does not
+    """
+
+    numba.get_num_threads()
+
+    return numba.threading_layer() != 'workqueue'
+
+def update_func_key(update_func):
+
+    """
+        a stable identifier for an update function, changes whenever its code (or closure contents) changes
+    """
+
+    func = getattr(update_func, 'py_func', update_func)
+    h = hashlib.sha1()
+    _hash_code(func, h, set())
+
+    return func.__name__, h.hexdigest()
+
+def _hash_code(func, h, seen):
+
+    """
+        hashes the code of func and of the helpers it calls, compiled functions found in its globals and anything
+        listed in a depends attribute (e.g. the @overload implementations behind complex_dynamics.ipow, which
+        can not be found from the globals), so that cached kernels are rebuilt when a helper changes
+    """
+
+    seen.add(id(func))
+    closure = tuple(cell.cell_contents for cell in func.__closure__) if func.__closure__ else ()
+
+    h.update(repr((func.__module__, func.__qualname__, closure)).encode())
+    _hash_code_object(func.__code__, h)
+
+    helpers = [func.__globals__.get(name) for name in func.__code__.co_names]
+    helpers = [f for f in helpers if isinstance(f, CPUDispatcher) or hasattr(f, 'depends')] + list(getattr(func, 'depends', ()))
+
+    for helper in helpers:
+        helper = getattr(helper, 'py_func', helper)
+        if id(helper) not in seen:
+            _hash_code(helper, h, seen)
+
+def _hash_code_object(code, h):
+
+    # nested code objects (lambdas, inner functions) are hashed by content, their repr includes an address
+    consts = tuple(c for c in code.co_consts if not isinstance(c, CodeType))
+    h.update(repr((code.co_code, consts, code.co_names)).encode())
+
+    for c in code.co_consts:
+        if isinstance(c, CodeType):
+            _hash_code_object(c, h)
+
+def _template_source(template):
+
+    lines = textwrap.dedent(inspect.getsource(template)).splitlines()
+    while lines[0].startswith('@'):
+        lines.pop(0)
+
+    options = 'cache=True, nogil=True'
+    if template.parallel:
+        options += ', parallel=True'
+
+    return '@njit(' + options + ')\n' + '\n'.join(lines) + '\n'
+
+def _cache_dir():
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        return CACHE_DIR
+    except OSError:
+        return tempfile.gettempdir()
+
+def specialize(update_func, templates, dtype='float64'):
+
+    """
+        returns a module holding jitted versions of the template functions with update_func and the
+        float/complex dtypes bound, compiled kernels are kept in memory and cached on disk, keyed by
+        the update function and dtype
+    """
+
+    dtype = np.dtype(dtype).name
+    templates = tuple(templates)
+
+    if not isinstance(update_func, CPUDispatcher):
+        update_func = njit(update_func)
+
+    name, func_hash = update_func_key(update_func)
+    key = (tuple(t.__module__ + '.' + t.__qualname__ for t in templates), func_hash, dtype)
+
+    if key in _kernels:
+        return _kernels[key]
+
+    source = 'from numba import njit, prange\n\n' + '\n'.join(_template_source(t) for t in templates)
+    source_hash = hashlib.sha1((source + func_hash + dtype).encode()).hexdigest()[:16]
+    modname = '_'.join(('kernel', name, dtype, source_hash))
+    path = os.path.join(_cache_dir(), modname + '.py')
+
+    if not os.path.exists(path):
+        with open(path + '.tmp', 'w') as f:
+            f.write(source)
+        os.replace(path + '.tmp', path)
+
+    FLOAT, COMPLEX = DTYPES[dtype]
+    module = ModuleType(modname)
+    for t in templates:
+        module.__dict__.update((k, v) for k, v in t.__globals__.items() if not k.startswith('__'))
+    module.__dict__.update(__file__=path, update_func=update_func, FLOAT=FLOAT, COMPLEX=COMPLEX)
+
+    # numba re-imports the module by name when loading cached kernels
+    sys.modules[modname] = module
+    exec(compile(source, path, 'exec'), module.__dict__)
+    _kernels[key] = module
+
+    return module
@@ -0,0 +1,150 @@
+import json
+import zlib
+import struct
+import numpy as np
+
+# a small binary format for (lattice, width, height, dpi) tuples, a magic string, the length of a JSON header and
+# the header (padded so that the data starts on a 64 byte boundary), then the raw array data (zlib compressed
+# if the header says so), uncompressed files can be memory-mapped without reading them into RAM
+
+MAGIC = b'\x93FRACTAL'
+VERSION = 1
+ALIGN = 64
+CHUNK = 1 << 24
+
+def _json_value(v):
+
+    if isinstance(v, np.generic):
+        return v.item()
+    if isinstance(v, np.ndarray):
+        return v.tolist()
+    if callable(v):
+        return getattr(v, '__name__', str(v))
+
+    return str(v)
+
+def _write_header(f, header):
+
+    text = json.dumps(header, default=_json_value).encode()
+    pad = -(len(MAGIC) + 4 + len(text)) % ALIGN
+    text += b' '*pad
+
+    f.write(MAGIC + struct.pack('<I', len(text)) + text)
+
+    return len(MAGIC) + 4 + len(text)
+
+def _header(A, width, height, dpi, fortran_order, compression, meta):
+
+    header = dict(version=VERSION, dtype=A.dtype.str, shape=list(A.shape), fortran_order=fortran_order, compression=compression,
+                  width=width, height=height, dpi=dpi)
+
+    for key in ('bounds', 'maxiter', 'update_func', 'seed'):
+        header[key] = meta.pop(key, None)
+    header.update(meta)
+
+    return header
+
+def lattice_header(filename):
+
+    """
+        reads the header of a lattice file, returns it as a dict with the data offset added as 'offset'
+    """
+
+    with open(filename, 'rb') as f:
+
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(filename + ' is not a lattice file')
+
+        size, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(size))
+
+    header['offset'] = len(MAGIC) + 4 + size
+
+    return header
+
+def save_lattice(lattice, filename, compress=False, level=1, **meta):
+
+    """
+        writes a (lattice, width, height, dpi) tuple to filename, metadata such as bounds, maxiter, update_func
+        (stored by name) and seed can be passed as keywords and is kept in the header, compress=True zlib
+        compresses the data (such files can not be memory-mapped)
+    """
+
+    A, width, height, dpi = lattice
+    A = np.asanyarray(A)
+
+    fortran_order = bool(A.flags.f_contiguous and not A.flags.c_contiguous)
+    data = np.ascontiguousarray(A.T if fortran_order else A)
+    header = _header(A, width, height, dpi, fortran_order, 'zlib' if compress else None, meta)
+
+    flat = data.reshape(-1).view(np.uint8)
+
+    with open(filename, 'wb') as f:
+
+        _write_header(f, header)
+
+        if compress:
+            compressor = zlib.compressobj(level)
+            for k in range(0, len(flat), CHUNK):
+                f.write(compressor.compress(flat[k:k + CHUNK]))
+            f.write(compressor.flush())
+        else:
+            for k in range(0, len(flat), CHUNK):
+                f.write(flat[k:k + CHUNK])
+
+def create_lattice(filename, shape, dtype=np.float64, width=5, height=5, dpi=100, fortran_order=False, **meta):
+
+    """
+        creates an uncompressed lattice file of zeros and returns it as a writable numpy.memmap, for lattices
+        that are filled in place (e.g. by tiled.render_tiled)
+    """
+
+    A = np.empty((0,), dtype=dtype)
+    header = _header(A, width, height, dpi, fortran_order, None, meta)
+    header['shape'] = [int(n) for n in shape]
+
+    with open(filename, 'wb') as f:
+        offset = _write_header(f, header)
+        f.truncate(offset + int(np.prod(shape))*A.itemsize)
+
+    return np.memmap(filename, dtype=dtype, mode='r+', offset=offset, shape=tuple(shape), order='F' if fortran_order else 'C')
+
+def open_lattice(filename, mmap_mode=None):
+
+    """
+        reads a lattice file back into a (lattice, width, height, dpi) tuple, with mmap_mode ('r', 'r+' or 'c')
+        the lattice is a numpy.memmap of the file instead of an array in memory
+    """
+
+    header = lattice_header(filename)
+    dtype = np.dtype(header['dtype'])
+    shape = tuple(header['shape'])
+    order = 'F' if header['fortran_order'] else 'C'
+    tup = (header['width'], header['height'], header['dpi'])
+
+    if mmap_mode is not None:
+        if header['compression'] is not None:
+            raise ValueError('compressed lattice files can not be memory-mapped')
+        return (np.memmap(filename, dtype=dtype, mode=mmap_mode, offset=header['offset'], shape=shape, order=order),) + tup
+
+    A = np.empty(shape, dtype=dtype, order=order)
+    flat = (A.T if header['fortran_order'] else A).reshape(-1).view(np.uint8)
+
+    with open(filename, 'rb') as f:
+
+        f.seek(header['offset'])
+
+        if header['compression'] == 'zlib':
+            decompressor = zlib.decompressobj()
+            k = 0
+            while k < len(flat):
+                data = decompressor.unconsumed_tail or f.read(CHUNK)
+                if not data:
+                    raise ValueError(filename + ' is truncated')
+                chunk = decompressor.decompress(data, CHUNK)
+                flat[k:k + len(chunk)] = np.frombuffer(chunk, dtype=np.uint8)
+                k += len(chunk)
+        elif f.readinto(flat) != len(flat):
+            raise ValueError(filename + ' is truncated')
+
+    return (A,) + tup
@@ -1,57 +1,146 @@
 import numpy as np
-from numba import jit, prange
+from numba import njit, prange
+from grid import grid, precision_dtype
 from image_creation import *
 from matplotlib import pyplot as plt
 import matplotlib.colors as mcolors
 
-@jit
-def lyapunov(string, xbound, ybound, maxiter=100, width=3, height=3, dpi=100, transpose=False):
+def sequence(string, letters='AB'):
 
     """
-        returns a Lyupanov fractal according to the proved string (e.g. 'ABAA')
+        the string (e.g. 'AAAABA') as an array of letter indices, so the kernel does no string handling
     """
 
-    L = len(string)
+    if not string or any(S not in letters for S in string):
+        raise ValueError('string must be a non-empty sequence of the letters ' + letters)
 
-    xmin,xmax = [float(xbound[0]),float(xbound[1])]
-    ymin,ymax = [float(ybound[0]),float(ybound[1])]
-    nx = width*dpi
-    ny = height*dpi
+    return np.array([letters.index(S) for S in string], dtype=np.int64)
 
-    xvals  = np.array([xmin + i*(xmax - xmin)/(nx) for i in range(nx)], dtype=np.float64)
-    yvals  = np.array([ymin + i*(ymax - ymin)/(ny) for i in range(ny)], dtype=np.float64)
+# the number of successive block means that must agree to within tol before a pixel stops early
 
-    lattice = np.zeros((int(nx), int(ny)), dtype=np.float64)
+AGREE = 3
+
+@njit(cache=True, nogil=True)
+def _exponent(seq, r, x0, warmup, maxiter, tol):
+
+    """
+        the Lyapunov exponent of the logistic map x -> r_n*x*(1 - x) with r_n = r[seq[n % len(seq)]], the first warmup
+        iterations are discarded, if tol > 0 the mean over each block of check iterations (a whole number of periods
+        of the sequence) is compared with the previous block's and once AGREE successive blocks agree to within tol
+        the sum so far plus the last block's mean over the remaining iterations is returned, the map is iterated in
+        the precision of r (the sum of the logs is kept in double precision)
+    """
+
+    L = len(seq)
+    check = L*max(1, 64//L)
+    one = r.dtype.type(1)
+    x = r.dtype.type(x0)
+
+    for n in range(warmup):
+        x = r[seq[n%L]]*x*(one - x)
+
+    lamd = 0.0
+    prev = 0.0
+    last = np.inf
+    agree = 0
+    prod = one
+
+    for n in range(maxiter):
+
+        rn = r[seq[(warmup + n)%L]]
+        x = (rn*x)*(one - x)
+        prod *= np.abs(rn*(one - (x + x)))
+
+        # |r*(1 - 2*x)| <= 4, so 8 factors can be multiplied before taking a single log
+        if (n + 1)%8 == 0:
+            lamd += np.log(prod)
+            prod = one
+
+        # the running mean changes like 1/n whatever the error, so the means of successive blocks are compared
+        if tol > 0.0 and (n + 1)%check == 0:
+            lamd += np.log(prod)
+            prod = one
+            block = (lamd - prev)/check
+            prev = lamd
+            agree = agree + 1 if abs(block - last) < tol else 0
+            if agree == AGREE:
+                return (lamd + block*(maxiter - n - 1))/maxiter
+            last = block
+
+    return (lamd + np.log(prod))/maxiter
+
+@njit(cache=True, parallel=True)
+def _lyapunov_kernel(seqs, lengths, xvals, yvals, zvals, x0, warmup, maxiter, tol):
+
+    """
+        the exponents of every sequence (the rows of seqs, padded, with lengths) at every C value in zvals for every
+        pixel in one pass, layer s*len(zvals) + k of the lattice is sequence s with C = zvals[k], the lattice (and the
+        arithmetic) has the dtype of xvals
+    """
+
+    nz = len(zvals)
+    lattice = np.zeros((len(xvals), len(yvals), len(lengths)*nz), dtype=xvals.dtype)
 
     for i in prange(len(xvals)):
-        for j in prange(len(yvals)):
 
-            count = 0
-            x = 0.5
-            lamd = 0.0
+        r = np.empty(3, dtype=xvals.dtype)
+        r[0] = xvals[i]
+
+        for j in range(len(yvals)):
+            r[1] = yvals[j]
+            for s in range(len(lengths)):
+                for k in range(nz):
+                    r[2] = zvals[k]
+                    lattice[i,j,s*nz + k] = _exponent(seqs[s,:lengths[s]], r, x0, warmup, maxiter, tol)
+
+    return lattice
+
+def lyapunov_batch(strings, xbound, ybound, zvals=None, maxiter=100, width=3, height=3, dpi=100, warmup=0, x0=0.5, tol=0.0, precision='double'):
 
-            xv = xvals[j]
-            yv = xvals[i]
+    """
+        Lyapunov fractals for several strings (over the letters A, B and C) on the same grid in one parallel pass,
+        A is varied along the x axis, B along the y axis and C takes each of the fixed values in zvals (needed only
+        if a string uses C), returns a stacked (nx, ny, len(strings)*len(zvals)) lattice where layer s*len(zvals) + k
+        is strings[s] at zvals[k], see lyapunov for the other arguments, precision='single' computes a float32 lattice
+        (see grid.precision_dtype)
+    """
 
-            for n in range(maxiter):
+    strings = [strings] if isinstance(strings, str) else list(strings)
+    seqs = [sequence(string, letters='ABC') for string in strings]
 
-                S = string[count%L]
-                if S == 'A':
-                    rn = xv
-                else:
-                    rn = yv
-                count += 1
+    if zvals is None:
+        if any((seq == 2).any() for seq in seqs):
+            raise ValueError('zvals (the values of C) must be given for strings using C')
+        zvals = [0.0]
 
-                x = (rn*x)*(1-x)
-                lamd += np.log(np.abs(rn*(1-(2*x))))
-                
-            lattice[i,j] += lamd
-            lamd /= maxiter
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    packed = np.zeros((len(seqs), lengths.max()), dtype=np.int64)
+    for s, seq in enumerate(seqs):
+        packed[s,:len(seq)] = seq
+
+    dtype = precision_dtype(precision, xbound, ybound, width=width, height=height, dpi=dpi)
+    xvals, yvals = grid(xbound, ybound, width=width, height=height, dpi=dpi, dtype=dtype)
+    lattice = _lyapunov_kernel(packed, lengths, xvals, yvals, np.asarray(zvals, dtype=dtype), x0, warmup, maxiter, tol)
+
+    return (lattice, width, height, dpi)
+
+def lyapunov(string, xbound, ybound, maxiter=100, width=3, height=3, dpi=100, transpose=False, warmup=0, x0=0.5, tol=0.0, precision='double'):
+
+    """
+        returns a Lyupanov fractal according to the proved string (e.g. 'ABAA'), A is varied along the x axis and B
+        along the y axis, each pixel is the mean exponent over maxiter iterations after warmup transient ones, with
+        tol > 0 pixels stop early once the means of successive blocks of iterations agree to within tol (a convergence
+        test, not a bound on the error of the maxiter mean), precision='single' iterates in float32 and returns a
+        float32 lattice (for previews)
+    """
+
+    lattice = lyapunov_batch([string], xbound, ybound, maxiter=maxiter, width=width, height=height, dpi=dpi, warmup=warmup, x0=x0, tol=tol,
+                             precision=precision)[0][:,:,0]
 
     if transpose:
         lattice = lattice.T
 
-    return (lattice, width, height, dpi)
+    return (np.ascontiguousarray(lattice), width, height, dpi)
 
 if __name__ == '__main__':
 
@@ -65,5 +154,5 @@ if __name__ == '__main__':
     yB = (2.45, 4.0)
 
     im = lyapunov(string, xB, yB, maxiter=100, dpi=300, width=4, height=3)
-    image(im, gamma=3.0, vert_exag=10000.0, cmap=mymap)    
+    image(im, gamma=3.0, vert_exag=1000000.0, cmap=mymap)    
     
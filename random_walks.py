@@ -1,11 +1,17 @@
 import numpy as np
 from numpy import array
-from numpy.random import randint
 from itertools import combinations
-from numba import jit
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
+from kernel_cache import get_num_threads
+from sparse_lattice import ChunkedLattice, _chunk_key
 from image_creation import random_walk_3D_image
 from matplotlib import pyplot as plt
 
+# the memory the extra per-thread lattices of a dense walk may take (each thread beyond the first walks into its own)
+
+DENSE_WALK_BYTES = 2**30
+
 def construct_moves(basis):
 
     basis = np.r_[basis,-1*basis,[array([0,0,0])]]
@@ -14,36 +20,207 @@ def construct_moves(basis):
 
     return moves
 
-@jit(nopython=True)
-def random_walk_3D(moves, niter, width=5, height=5, depth=1, dpi=100, tracking='visitation', displacement=0.0, bias=0):
+@njit(cache=True, nogil=True)
+def _walk_block(lattice, moves, draws, pos, n0, temporal):
+
+    """
+        takes one step per entry of draws (indices into moves) from pos (updated in place), positions are kept as
+        integers wrapped into the lattice, cells are counted (visitation) or get the earliest step at which they
+        were visited (temporal, a step of 0 is treated as unvisited as before and is never written, so it cannot
+        erase an earlier walker's time in a shared lattice)
+    """
+
+    l0, l1, l2 = lattice.shape
+    i, j, k = pos[0], pos[1], pos[2]
+
+    for n in range(len(draws)):
+
+        m = draws[n]
+        i += moves[m,0]
+        j += moves[m,1]
+        k += moves[m,2]
+
+        while i >= l0:
+            i -= l0
+        while i < 0:
+            i += l0
+        while j >= l1:
+            j -= l1
+        while j < 0:
+            j += l1
+        while k >= l2:
+            k -= l2
+        while k < 0:
+            k += l2
+
+        if temporal:
+            t = n0 + n
+            if t > 0 and (lattice[i,j,k] == 0 or t < lattice[i,j,k]):
+                lattice[i,j,k] = t
+        else:
+            lattice[i,j,k] += 1
+
+    pos[0], pos[1], pos[2] = i, j, k
+
+@njit(cache=True, nogil=True)
+def _walk_block_chunked(chunks, shape, csize, nchunks, moves, draws, pos, n0, temporal):
+
+    """
+        _walk_block writing into the chunks of a ChunkedLattice, chunks are allocated as the walk enters them
+    """
+
+    l0, l1, l2 = shape[0], shape[1], shape[2]
+    i, j, k = pos[0], pos[1], pos[2]
+    key = -1
+    chunk = np.zeros((1, 1, 1), dtype=np.int64)
+
+    for n in range(len(draws)):
+
+        m = draws[n]
+        i += moves[m,0]
+        j += moves[m,1]
+        k += moves[m,2]
+
+        while i >= l0:
+            i -= l0
+        while i < 0:
+            i += l0
+        while j >= l1:
+            j -= l1
+        while j < 0:
+            j += l1
+        while k >= l2:
+            k -= l2
+        while k < 0:
+            k += l2
+
+        ckey = _chunk_key(i, j, k, csize, nchunks)
+        if ckey != key:
+            if ckey not in chunks:
+                chunks[ckey] = np.zeros((csize[0], csize[1], csize[2]), dtype=np.int64)
+            chunk = chunks[ckey]
+            key = ckey
+
+        a, b, c = i%csize[0], j%csize[1], k%csize[2]
+
+        if temporal:
+            t = n0 + n
+            if t > 0 and (chunk[a,b,c] == 0 or t < chunk[a,b,c]):
+                chunk[a,b,c] = t
+        else:
+            chunk[a,b,c] += 1
+
+    pos[0], pos[1], pos[2] = i, j, k
+
+@njit(cache=True, nogil=True)
+def _merge_dense(counts, part, temporal):
+
+    """
+        merges part into counts in place, summed (visitation) or the earliest nonzero visit (temporal)
+    """
+
+    flat = counts.ravel()
+    src = part.ravel()
+
+    for n in range(len(flat)):
+        if temporal:
+            if flat[n] == 0 or (src[n] != 0 and src[n] < flat[n]):
+                flat[n] = src[n]
+        else:
+            flat[n] += src[n]
+
+def _normalize_in_place(counts):
+
+    """
+        the counts (uint32) converted to float32 in their own memory and divided by their maximum, one plane at a
+        time so that no full size temporary is made
+    """
+
+    lattice = counts.view(np.float32)
+
+    for i in range(len(counts)):
+        lattice[i] = counts[i]
+
+    lattice /= np.amax(lattice)
+
+    return lattice
+
+def _walkers(lattice, moves, niter, start, seeds, nchoices, temporal, block):
+
+    sparse = isinstance(lattice, ChunkedLattice)
+    shape = np.array(lattice.shape, dtype=np.int64)
+
+    for seed in seeds:
+
+        rng = np.random.Generator(np.random.PCG64(seed))
+        pos = start.copy()
+
+        for n0 in range(0, niter, block):
+            draws = rng.integers(0, nchoices, size=min(block, niter - n0), dtype=np.uint8)
+            if sparse:
+                _walk_block_chunked(lattice.chunks, shape, lattice.csize, lattice.nchunks, moves, draws, pos, n0, temporal)
+            else:
+                _walk_block(lattice, moves, draws, pos, n0, temporal)
+
+    return lattice
+
+def random_walk_3D(moves, niter, width=5, height=5, depth=1, dpi=100, tracking='visitation', displacement=0.0, bias=0, walkers=1, seed=None, workers=None, block=2**20,
+                   sparse=False, chunk=16):
 
     """
         A 3D random walk on a lattice, points can be colored by the number of times visited or by the step number (time)
+
+        walkers independent walks of niter steps each start from the same point, each with its own random stream
+        (spawned from seed), move indices are drawn in blocks of block steps and the walks are run on workers
+        threads, each thread walks into its own lattice and the lattices are merged at the end (summed for
+        visitation, the earliest visit for temporal)
+
+        dense lattices count in uint32 and are normalized in place into the float32 result, the number of threads
+        is capped so that the extra private lattices take at most DENSE_WALK_BYTES, for volumes where that leaves
+        a single thread (or a single lattice does not fit in memory) use sparse=True
+
+        sparse=True walks into a ChunkedLattice (chunks of chunk cells along each axis, allocated only where the walks
+        go) which is returned in place of the array, holding the raw counts/times, its densify() method gives the
+        normalized array and random_walk_3D_image takes it directly
     """
 
-    lattice = np.zeros((int(height*dpi), int(width*dpi), int(depth)), dtype=np.float32)
+    if tracking not in ('visitation', 'temporal'):
+        raise ValueError('tracking must be visitation or temporal')
+
+    temporal = tracking == 'temporal'
     shape = array([height*dpi, width*dpi, depth])
-    nmoves = len(moves)
-    
-    start = array([height*dpi, width*dpi, depth])/2.0 + displacement*shape
+    dims = tuple(int(l) for l in shape)
+    start = np.floor(shape/2.0 + displacement*shape).astype(np.int64) % array(dims)
 
-    l0,l1,l2 = shape
-    indices = start
+    moves = np.ascontiguousarray(moves, dtype=np.int64)
+    nchoices = len(moves) - bias
+    if not 0 < nchoices <= 256:
+        raise ValueError('bias must leave between 1 and 256 moves')
 
-    for n in range(niter):
+    if not sparse and niter*(1 if temporal else walkers) >= 2**32:
+        raise ValueError('dense lattices count in uint32, use sparse=True for more than 2**32 steps per cell')
 
-        move = moves[randint(0, nmoves-bias)]
-        indices += move
-        i,j,k = int(indices[0]%l0), int(indices[1]%l1), int(indices[2]%l2)
+    seeds = np.random.SeedSequence(seed).spawn(walkers)
+    workers = min(walkers, get_num_threads() if workers is None else int(workers))
+    if not sparse:
+        workers = max(1, min(workers, 1 + DENSE_WALK_BYTES//(4*int(np.prod(dims)))))
 
-        if tracking == 'visitation':
-            lattice[i,j,k] += 1.0
-        elif tracking == 'temporal':
-            if lattice[i,j,k] == 0.0: lattice[i,j,k] += n
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(_walkers, ChunkedLattice(dims, chunk=chunk) if sparse else np.zeros(dims, dtype=np.uint32), moves, niter, start, seeds[w::workers], nchoices, temporal, block)
+                for w in range(workers)]
+        parts = [job.result() for job in jobs]
+        del jobs
 
-    lattice /= np.amax(lattice)
+    if sparse:
+        for part in parts[1:]:
+            parts[0].merge(part, temporal=temporal)
+        return (parts[0], width, height, dpi)
+
+    counts = parts.pop(0)
+    while parts:
+        _merge_dense(counts, parts.pop(), temporal)
 
-    return (lattice, width, height, dpi)
+    return (_normalize_in_place(counts), width, height, dpi)
 
 if __name__ == '__main__':
 
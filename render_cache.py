@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import hashlib
+import inspect
+import numpy as np
+from kernel_cache import update_func_key
+from complex_dynamics import mandelbrot, julia, power
+from lyapunov import lyapunov
+from buddhabrot import buddhabrot
+from lattice_io import save_lattice, open_lattice
+
+# a persistent cache of rendered lattices, keyed on a hash of the function and all of the arguments that affect
+# its result, so re-coloring a view (image, gamma, cmap, ...) does not recompute it
+
+RENDER_CACHE_DIR = os.environ.get('FRACTAL_RENDER_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'pythonfractals', 'renders'))
+
+# arguments that do not change the lattice
+IGNORED = ('stats', 'workers', 'backend')
+
+def _canonical(v):
+
+    """
+        a JSON-able version of an argument, functions are identified by their code and arrays by their contents
+    """
+
+    if callable(v):
+        return list(update_func_key(v))
+    if isinstance(v, np.ndarray):
+        return [v.dtype.str, list(v.shape), hashlib.sha1(np.ascontiguousarray(v).view(np.uint8)).hexdigest()]
+    if isinstance(v, (complex, np.complexfloating)):
+        return [float(v.real), float(v.imag)]
+    if isinstance(v, np.generic):
+        return v.item()
+    if isinstance(v, (tuple, list)):
+        return [_canonical(u) for u in v]
+
+    return v if isinstance(v, (int, float, str, bool, type(None))) else repr(v)
+
+def _reduce_maxiter(A, maxiter, log_smooth):
+
+    """
+        the lattice a lower maxiter would have given, a pixel escaped on iteration n = ceil(value) (the smoothing
+        term is in [0, 1) for z**2 + c) and would not have escaped if n >= maxiter
+    """
+
+    n = np.ceil(A) if log_smooth else A
+    A[n >= maxiter] = 0.0
+
+    return A
+
+class RenderCache:
+
+    """
+        caches the lattices of mandelbrot, julia, lyapunov and buddhabrot on disk (in directory, the
+        FRACTAL_RENDER_CACHE environment variable or ~/.cache/pythonfractals/renders), the least recently used
+        renders are evicted once the cache holds more than max_bytes, stats counts hits, partial_hits (a cached
+        render at a higher maxiter reused, see _reduce_maxiter), misses and evictions
+    """
+
+    def __init__(self, directory=None, max_bytes=2**30, compress=False):
+
+        self.directory = RENDER_CACHE_DIR if directory is None else directory
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.stats = dict(hits=0, partial_hits=0, misses=0, evictions=0)
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._index_file = os.path.join(self.directory, 'index.json')
+
+        try:
+            with open(self._index_file) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def _save_index(self):
+
+        with open(self._index_file + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+
+        os.replace(self._index_file + '.tmp', self._index_file)
+
+    def _keys(self, func, args, kwargs):
+
+        bound = inspect.signature(func).bind(*args, **kwargs)
+        bound.apply_defaults()
+        params = dict((k, _canonical(v)) for k, v in bound.arguments.items() if k not in IGNORED)
+        maxiter = params.pop('maxiter', None)
+
+        family = hashlib.sha1(json.dumps([func.__name__, params], sort_keys=True).encode()).hexdigest()
+        key = hashlib.sha1(json.dumps([family, maxiter]).encode()).hexdigest()
+
+        return key, family, maxiter, bound.arguments
+
+    def _load(self, key):
+
+        entry = self.index[key]
+        entry['used'] = time.time()
+
+        try:
+            return open_lattice(os.path.join(self.directory, entry['file']))
+        except (OSError, ValueError):
+            del self.index[key]
+            return None
+
+    def _partial(self, family, maxiter, arguments):
+
+        """
+            the smallest cached render of the same view at a higher maxiter, for the escape-time functions
+            where the escape iteration can be recovered from the value (not for supersampled renders, whose
+            pixels are means of several escape times)
+        """
+
+        if maxiter is None or not (not arguments['log_smooth'] or (arguments['update_func'] is power and arguments['args'] == 2)):
+            return None
+        if arguments.get('antialias', 1) > 1:
+            return None
+
+        higher = [(e['maxiter'], k) for k, e in self.index.items() if e['family'] == family and e['maxiter'] > maxiter]
+
+        for m, key in sorted(higher):
+            lattice = self._load(key)
+            if lattice is not None:
+                return (_reduce_maxiter(lattice[0], maxiter, arguments['log_smooth']),) + lattice[1:]
+
+        return None
+
+    def _store(self, key, family, maxiter, lattice):
+
+        filename = key + '.lattice'
+        path = os.path.join(self.directory, filename)
+        save_lattice(lattice, path, compress=self.compress)
+
+        self.index[key] = dict(file=filename, bytes=os.path.getsize(path), used=time.time(), family=family, maxiter=maxiter)
+        self._evict()
+
+    def _evict(self):
+
+        total = sum(e['bytes'] for e in self.index.values())
+
+        for key in sorted(self.index, key=lambda k: self.index[k]['used']):
+            if total <= self.max_bytes:
+                break
+            total -= self.index[key]['bytes']
+            try:
+                os.remove(os.path.join(self.directory, self.index[key]['file']))
+            except OSError:
+                pass
+            del self.index[key]
+            self.stats['evictions'] += 1
+
+    def render(self, func, *args, **kwargs):
+
+        """
+            returns func(*args, **kwargs) from the cache if possible, otherwise computes and caches it
+        """
+
+        key, family, maxiter, arguments = self._keys(func, args, kwargs)
+        lattice = self._load(key) if key in self.index else None
+
+        if lattice is not None:
+            self.stats['hits'] += 1
+        else:
+            lattice = self._partial(family, maxiter, arguments) if func in (mandelbrot, julia) else None
+            if lattice is not None:
+                self.stats['partial_hits'] += 1
+            else:
+                self.stats['misses'] += 1
+                lattice = func(*args, **kwargs)
+            self._store(key, family, maxiter, lattice)
+
+        self._save_index()
+
+        return lattice
+
+    def mandelbrot(self, *args, **kwargs):
+
+        return self.render(mandelbrot, *args, **kwargs)
+
+    def julia(self, *args, **kwargs):
+
+        return self.render(julia, *args, **kwargs)
+
+    def lyapunov(self, *args, **kwargs):
+
+        return self.render(lyapunov, *args, **kwargs)
+
+    def buddhabrot(self, *args, **kwargs):
+
+        return self.render(buddhabrot, *args, **kwargs)
+
+    def clear(self):
+
+        for entry in self.index.values():
+            try:
+                os.remove(os.path.join(self.directory, entry['file']))
+            except OSError:
+                pass
+
+        self.index = {}
+        self._save_index()
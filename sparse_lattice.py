@@ -0,0 +1,129 @@
+import numpy as np
+from numba import njit, types
+from numba.typed import Dict
+
+# a sparse 3D lattice for random walks, the lattice is split into chunks (blocks of at most chunk cells along each
+# axis) that are stored in a numba typed dict and only allocated once a walk first enters them
+
+@njit(cache=True, nogil=True)
+def _chunk_key(i, j, k, csize, nchunks):
+
+    return ((i//csize[0])*nchunks[1] + j//csize[1])*nchunks[2] + k//csize[2]
+
+@njit(cache=True, nogil=True)
+def _merge_chunks(chunks, other, temporal):
+
+    """
+        merges the chunks of other into chunks, summed (visitation) or the earliest nonzero visit (temporal)
+    """
+
+    for key, block in other.items():
+
+        if key not in chunks:
+            chunks[key] = block.copy()
+            continue
+
+        target = chunks[key]
+        flat = target.ravel()
+        src = block.ravel()
+
+        for n in range(len(flat)):
+            if temporal:
+                if flat[n] == 0 or (src[n] != 0 and src[n] < flat[n]):
+                    flat[n] = src[n]
+            else:
+                flat[n] += src[n]
+
+class ChunkedLattice:
+
+    """
+        a (l0, l1, l2) lattice of int64 counts stored as chunks, only the chunks that have been written to take
+        memory, densify() gives the normalized float32 array random_walk_3D returns for a dense lattice and
+        slices (e.g. lattice[:, :, k], a depth slice) are assembled from the chunks they overlap
+    """
+
+    def __init__(self, shape, chunk=16):
+
+        self.shape = tuple(int(l) for l in shape)
+        self.csize = np.array([min(chunk, l) for l in self.shape], dtype=np.int64)
+        self.nchunks = np.array([-(-l//c) for l, c in zip(self.shape, self.csize)], dtype=np.int64)
+        self.chunks = Dict.empty(key_type=types.int64, value_type=types.int64[:,:,::1])
+
+    @property
+    def ndim(self):
+
+        return 3
+
+    @property
+    def nbytes(self):
+
+        return sum(block.nbytes for block in self.chunks.values())
+
+    def merge(self, other, temporal=False):
+
+        _merge_chunks(self.chunks, other.chunks, temporal)
+
+    def _origin(self, key):
+
+        ck = key%self.nchunks[2]
+        cj = (key//self.nchunks[2])%self.nchunks[1]
+        ci = key//(self.nchunks[2]*self.nchunks[1])
+
+        return ci*self.csize[0], cj*self.csize[1], ck*self.csize[2]
+
+    def amax(self):
+
+        return max((block.max() for block in self.chunks.values()), default=0)
+
+    def __getitem__(self, key):
+
+        """
+            basic (unit step) slicing, returns a dense int64 array of the selected cells
+        """
+
+        key = key if isinstance(key, tuple) else (key,)
+        key = key + (slice(None),)*(3 - len(key))
+        ranges = []
+
+        for k, l in zip(key, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(l)
+                if step != 1:
+                    raise ValueError('ChunkedLattice slices must have unit step')
+                ranges.append((start, max(start, stop)))
+            else:
+                k = int(k) + l if int(k) < 0 else int(k)
+                ranges.append((k, k + 1))
+
+        out = np.zeros(tuple(b - a for a, b in ranges), dtype=np.int64)
+
+        for ck, block in self.chunks.items():
+            origin = self._origin(ck)
+            src = []
+            dst = []
+            for (a, b), o, c in zip(ranges, origin, self.csize):
+                lo, hi = max(a, o), min(b, o + c)
+                if lo >= hi:
+                    break
+                src.append(slice(lo - o, hi - o))
+                dst.append(slice(lo - a, hi - a))
+            else:
+                out[tuple(dst)] = block[tuple(src)]
+
+        return out[tuple(0 if not isinstance(k, slice) else slice(None) for k in key)]
+
+    def densify(self, normalize=True):
+
+        """
+            the dense lattice, as float32 divided by its maximum (as random_walk_3D returns it) if normalize
+        """
+
+        A = self[:, :, :]
+
+        if not normalize:
+            return A
+
+        lattice = A.astype(np.float32)
+        lattice /= np.amax(lattice)
+
+        return lattice
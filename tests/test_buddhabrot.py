@@ -0,0 +1,47 @@
+import os
+import numpy as np
+import pytest
+from complex_dynamics import power
+from buddhabrot import stream_buddhabrot, buddhabrot_channels, cval_batches
+
+VIEW = dict(xbound=(-2.0, 1.0), ybound=(-1.5, 1.5), update_func=power, width=1, height=1, dpi=40)
+KW = dict(maxiters=(20, 50, 100), importance_weight=0.0, batch_size=1000, seed=3)
+
+def test_stream_matches_batched_channels():
+
+    lattices = stream_buddhabrot(Ncvals=5000, checkpoint=None, workers=3, **VIEW, **KW)
+
+    expected = 0
+    batches = cval_batches(5000, VIEW['xbound'], VIEW['ybound'], power, width=1, height=1, dpi=40, importance_weight=0.0, batch_size=1000,
+                           rng=np.random.default_rng(3))
+    for cvals in batches:
+        expected = expected + np.array([L for L, w, h, d in buddhabrot_channels(cvals=cvals, maxiters=KW['maxiters'], **VIEW)])
+
+    np.testing.assert_array_equal(np.array([L for L, w, h, d in lattices]), expected)
+
+def test_stream_resumes_from_checkpoint(tmp_path, monkeypatch):
+
+    import buddhabrot
+
+    checkpoint = str(tmp_path / 'checkpoint.npz')
+    full = stream_buddhabrot(Ncvals=6000, checkpoint=None, **VIEW, **KW)
+
+    # interrupt a run at its 3000 sample preview (written just after the checkpoint), then resume it
+    def interrupt(*args, **kwargs):
+        raise RuntimeError('interrupted')
+
+    monkeypatch.setattr(buddhabrot, 'nebula_image', interrupt)
+    with pytest.raises(RuntimeError):
+        stream_buddhabrot(Ncvals=6000, checkpoint=checkpoint, checkpoint_every=3000, previews=(3000,), **VIEW, **KW)
+    monkeypatch.undo()
+
+    assert os.path.exists(checkpoint)
+    resumed = stream_buddhabrot(Ncvals=6000, checkpoint=checkpoint, checkpoint_every=3000, **VIEW, **KW)
+
+    for (A, *_), (B, *_) in zip(full, resumed):
+        np.testing.assert_array_equal(A, B)
+
+    # a finished job removes its checkpoint, so a new job with other parameters starts afresh
+    assert not os.path.exists(checkpoint)
+    stream_buddhabrot(Ncvals=2000, checkpoint=checkpoint, checkpoint_every=1000, **VIEW, **KW)
+    assert not os.path.exists(checkpoint)
@@ -0,0 +1,185 @@
+import numpy as np
+import pytest
+from complex_dynamics import mandelbrot, julia, power, cosine
+
+# small views, non-smoothed so that the filled rectangles of Mariani-Silver must match brute force exactly (this holds
+# for connected sets, the z**n + c Mandelbrot sets and the Julia sets of c inside them)
+
+VIEWS = [
+    ((-2.2, 0.8), (-1.5, 1.5), power, 2),
+    ((-0.75, -0.73), (0.1, 0.12), power, 2),
+    ((-1.5, 1.5), (-1.5, 1.5), power, 3),
+]
+
+@pytest.mark.parametrize('xbound, ybound, update_func, args', VIEWS)
+def test_mariani_silver_mandelbrot(xbound, ybound, update_func, args):
+
+    kw = dict(args=args, width=2, height=2, dpi=40, maxiter=200, log_smooth=False)
+    brute = mandelbrot(xbound, ybound, update_func, **kw)[0]
+    stats = {}
+    ms = mandelbrot(xbound, ybound, update_func, method='mariani_silver', stats=stats, **kw)[0]
+
+    np.testing.assert_array_equal(ms, brute)
+    assert stats['pixels_computed'] <= brute.size
+
+@pytest.mark.parametrize('c', [-0.8 + 0.156j, 0.285 + 0.01j, -0.4 + 0.6j])
+def test_mariani_silver_julia(c):
+
+    kw = dict(width=2, height=1.5, dpi=40, maxiter=200, log_smooth=False)
+    brute = julia(c, (-1.6, 1.6), (-1.2, 1.2), power, **kw)[0]
+    ms = julia(c, (-1.6, 1.6), (-1.2, 1.2), power, method='mariani_silver', **kw)[0]
+
+    np.testing.assert_array_equal(ms, brute)
+
+def test_update_func_key_follows_helpers():
+
+    # power reaches _ipow only through the @overload of ipow, both must be part of its kernel key
+    import hashlib
+    import complex_dynamics
+    from kernel_cache import _hash_code
+
+    seen = set()
+    _hash_code(power.py_func, hashlib.sha1(), seen)
+
+    assert id(complex_dynamics._ipow.py_func) in seen
+    assert id(complex_dynamics._ipow_overload) in seen
+
+def test_ipow_matches_pow():
+
+    from numba import njit
+    from complex_dynamics import ipow
+
+    f = njit(lambda z, n: ipow(z, n))
+
+    for z in (0.5 + 0.25j, -1.3 + 0.7j):
+        for n in (-3, -1, 0, 1, 2, 3, 7):
+            assert f(z, n) == pytest.approx(z**n, rel=1e-12)
+
+    assert np.isnan(f(0j, -2))
+
+def test_negative_power_through_zero():
+
+    # c = 0 lies on the grid, where z**-2 is nan, the render must still finish
+    A = mandelbrot((-2, 2), (-2, 2), power, args=-2, width=1, height=1, dpi=40)[0]
+
+    assert np.isfinite(A).all()
+
+@pytest.mark.parametrize('update_func, args', [(power, 3), (power, 4), (power, 5), (power, 8)])
+@pytest.mark.parametrize('method', ['brute', 'mariani_silver'])
+def test_single_precision_finite(update_func, args, method):
+
+    # maps growing faster than z**2 overflow complex64 just past the double precision horizon
+    kw = dict(args=args, width=1, height=1, dpi=100, maxiter=100, method=method)
+    single = mandelbrot((-1.5, 1.5), (-1.5, 1.5), update_func, precision='single', **kw)[0]
+    double = mandelbrot((-1.5, 1.5), (-1.5, 1.5), update_func, **kw)[0]
+
+    assert single.dtype == np.float32
+    assert np.isfinite(single).all()
+    assert np.isfinite(double).all()
+
+    assert np.mean((single > 0) != (double > 0)) < 0.01
+
+    # the log2 smoothing is only continuous for low degrees, beyond that the escape iteration can move by whole bands
+    if args <= 5:
+        escaped = (single > 0) & (double > 0)
+        assert np.median(np.abs(single[escaped] - double[escaped])) < 1e-3
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_julia_frames_threads(workers):
+
+    from complex_dynamics import julia_frames
+
+    c_vals = [-0.8 + 0.156j, 0.285 + 0.01j, -0.4 + 0.6j, -0.7 + 0.27j]
+    kw = dict(width=1, height=1, dpi=30, maxiter=50)
+    frames = list(julia_frames(c_vals, (-1.5, 1.5), (-1.5, 1.5), power, backend='threads', workers=workers, **kw))
+
+    assert len(frames) == len(c_vals)
+    for c, frame in zip(c_vals, frames):
+        np.testing.assert_array_equal(frame[0], julia(c, (-1.5, 1.5), (-1.5, 1.5), power, **kw)[0])
+
+@pytest.mark.parametrize('log_smooth', [True, False])
+def test_incremental_julia_series(log_smooth):
+
+    from complex_dynamics import julia_series
+
+    c_vals = 0.3*np.exp(1j*np.linspace(0.0, 2*np.pi, 12)) - 0.2
+    kw = dict(width=1, height=1, dpi=60, maxiter=80, log_smooth=log_smooth)
+    full = julia_series(c_vals, (-1.5, 1.5), (-1.5, 1.5), power, **kw)
+    stats = {}
+    series = julia_series(c_vals, (-1.5, 1.5), (-1.5, 1.5), power, incremental=True, stats=stats, **kw)
+
+    assert sum(stats['pixels_saved']) > 0
+    for frame, expected in zip(series, full):
+        np.testing.assert_allclose(frame[0], expected[0], rtol=0, atol=1e-6)
+
+def test_incremental_julia_series_unfilled_blocks():
+
+    from complex_dynamics import julia_series, magnetic_1
+
+    c_vals = [complex(x, 0.75) for x in np.linspace(0.05, 3.0, 12)]
+    kw = dict(width=1, height=1, dpi=40, maxiter=100)
+    full = julia_series(c_vals, (-1, 1), (-0.75, 1.25), magnetic_1, **kw)
+    series = julia_series(c_vals, (-1, 1), (-0.75, 1.25), magnetic_1, incremental=True, block=2, **kw)
+
+    for frame, expected in zip(series, full):
+        np.testing.assert_allclose(frame[0], expected[0], rtol=0, atol=1e-6)
+
+def test_julia_frames_threads_workqueue(monkeypatch):
+
+    import complex_dynamics
+    from complex_dynamics import julia_frames
+
+    monkeypatch.setattr(complex_dynamics, 'threadsafe_layer', lambda: False)
+    c_vals = [-0.8 + 0.156j, 0.285 + 0.01j]
+    kw = dict(width=1, height=1, dpi=30, maxiter=50)
+
+    with pytest.warns(UserWarning, match='workqueue'):
+        frames = list(julia_frames(c_vals, (-1.5, 1.5), (-1.5, 1.5), power, backend='threads', workers=3, **kw))
+
+    for c, frame in zip(c_vals, frames):
+        np.testing.assert_array_equal(frame[0], julia(c, (-1.5, 1.5), (-1.5, 1.5), power, **kw)[0])
+
+REFINE_VIEWS = [
+    dict(xbound=(-2.0, 1.0), ybound=(-1.5, 1.5), update_func=power, args=2),
+    dict(xbound=(-1.5, 1.5), ybound=(-1.5, 1.5), update_func=power, args=3),
+    dict(xbound=(-4.0, 4.0), ybound=(-4.0, 4.0), update_func=cosine, args=2),
+    dict(xbound=(-1.5, 1.5), ybound=(-1.5, 1.5), update_func=power, args=2, c=-0.8 + 0.156j),
+]
+
+@pytest.mark.parametrize('view', REFINE_VIEWS)
+def test_refine_matches_fresh_render(view):
+
+    from complex_dynamics import escape_state, refine
+
+    view = dict(view)
+    c = view.pop('c', None)
+    kw = dict(width=1, height=1, dpi=40)
+    state = escape_state(c=c, maxiter=20, **view, **kw)
+
+    for maxiter in (50, 120):
+        lattice = refine(state, maxiter)
+        fresh = mandelbrot(maxiter=maxiter, **view, **kw) if c is None else julia(c, maxiter=maxiter, **view, **kw)
+        np.testing.assert_array_equal(lattice[0], fresh[0])
+
+def test_state_round_trip(tmp_path):
+
+    from complex_dynamics import escape_state, refine, save_state, open_state
+
+    view = dict(REFINE_VIEWS[3])
+    c = view.pop('c')
+    state = escape_state(c=c, maxiter=30, width=1, height=1, dpi=40, **view)
+    filename = str(tmp_path/'state.npz')
+    save_state(state, filename)
+    opened = open_state(filename)
+
+    assert opened.keys() == state.keys()
+    for key in state:
+        if key == 'lattice':
+            np.testing.assert_array_equal(opened[key][0], state[key][0])
+            assert opened[key][1:] == state[key][1:]
+        elif key in ('idx', 'z'):
+            np.testing.assert_array_equal(opened[key], state[key])
+        else:
+            assert opened[key] == (list(state[key]) if isinstance(state[key], tuple) else state[key])
+
+    np.testing.assert_array_equal(refine(opened, 100)[0], refine(state, 100)[0])
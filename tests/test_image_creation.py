@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from matplotlib import pyplot as plt
+from PIL import Image
+from image_creation import colorize, shade, image, colormap_lut, bad_color
+
+def test_constant_lattice_is_lowest_color():
+
+    M = colorize(np.full((4, 3), 7.0), cmap=plt.cm.hot)
+
+    np.testing.assert_array_equal(M, np.broadcast_to(colormap_lut(plt.cm.hot)[0], (4, 3, 3)))
+
+def test_non_finite_values_get_bad_color():
+
+    A = np.linspace(-1.0, 1.0, 12).reshape(4, 3)
+    A[0,0], A[1,1], A[2,2] = -np.inf, np.inf, np.nan
+    M = colorize(A, cmap=plt.cm.hot)
+    finite = np.isfinite(A)
+
+    np.testing.assert_array_equal(M[~finite], np.broadcast_to(bad_color(plt.cm.hot), (3, 3)))
+    np.testing.assert_array_equal(M[finite], colorize(A[finite], cmap=plt.cm.hot))
+    assert shade(A, vert_exag=1.0).shape == (4, 3, 3)
+
+@pytest.mark.parametrize('vert_exag', [0, 1.0])
+@pytest.mark.parametrize('fill', [3.0, -np.inf])
+def test_direct_image_of_degenerate_lattice(tmp_path, fill, vert_exag):
+
+    A = np.full((20, 10), fill)
+    image((A, 1, 1, 20), filename=str(tmp_path/'f'), vert_exag=vert_exag, direct=True)
+
+    assert np.asarray(Image.open(tmp_path/'f.png')).shape == (10, 20, 3)
+
+def test_tiled_png_of_constant_view(tmp_path):
+
+    from tiled import render_tiled
+    from complex_dynamics import power
+
+    render_tiled((-0.1, 0.1), (-0.1, 0.1), power, width=1, height=1, dpi=16, tile=8, lattice_file=str(tmp_path/'m.lattice'), filename=str(tmp_path/'m'))
+
+    assert np.asarray(Image.open(tmp_path/'m.png')).shape == (16, 16, 3)
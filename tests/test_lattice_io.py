@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+import lattice_io
+from lattice_io import save_lattice, open_lattice, lattice_header, create_lattice
+from complex_dynamics import power
+
+BASE = np.arange(7*5*3, dtype=np.float64).reshape(7, 5, 3)*0.5 - 10.0
+
+ARRAYS = {
+    'c_order': BASE[:, :, 0].copy(),
+    'fortran_order': np.asfortranarray(BASE[:, :, 1]),
+    'transposed': BASE[:, :, 2].copy().T,
+    'strided': BASE[::2, 1:, ::2],
+    'float32': BASE[:, :, 0].astype(np.float32),
+    '3d_fortran': np.asfortranarray(BASE),
+}
+
+def round_trip(tmp_path, A, **kwargs):
+
+    filename = str(tmp_path/'a.lattice')
+    save_lattice((A, 4, 3, 50), filename, **kwargs)
+
+    return filename, open_lattice(filename)
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('name', list(ARRAYS))
+def test_round_trip(tmp_path, name, compress):
+
+    A = ARRAYS[name]
+    filename, (B, width, height, dpi) = round_trip(tmp_path, A, compress=compress)
+
+    assert (width, height, dpi) == (4, 3, 50)
+    assert B.dtype == A.dtype and B.shape == A.shape
+    np.testing.assert_array_equal(B, A)
+
+@pytest.mark.parametrize('name', list(ARRAYS))
+def test_memory_mapped(tmp_path, name):
+
+    A = ARRAYS[name]
+    filename = str(tmp_path/'a.lattice')
+    save_lattice((A, 4, 3, 50), filename)
+    B = open_lattice(filename, mmap_mode='r')[0]
+
+    assert isinstance(B, np.memmap)
+    assert lattice_header(filename)['offset'] % lattice_io.ALIGN == 0
+    np.testing.assert_array_equal(B, A)
+
+def test_compressed_in_chunks(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(lattice_io, 'CHUNK', 64)
+    A = np.random.default_rng(0).random((33, 21))
+    filename, (B, *_) = round_trip(tmp_path, A, compress=True)
+
+    np.testing.assert_array_equal(B, A)
+    with pytest.raises(ValueError):
+        open_lattice(filename, mmap_mode='r')
+
+def test_header_metadata(tmp_path):
+
+    filename = str(tmp_path/'a.lattice')
+    save_lattice((BASE[:, :, 0], 4, 3, 50), filename, bounds=[(-2.0, 1.0), np.array([-1.5, 1.5])], maxiter=np.int64(100), update_func=power,
+                 seed=7, c=0.25)
+    header = lattice_header(filename)
+
+    assert header['bounds'] == [[-2.0, 1.0], [-1.5, 1.5]]
+    assert header['maxiter'] == 100
+    assert header['update_func'] == 'power'
+    assert header['seed'] == 7
+    assert header['c'] == 0.25
+    assert header['shape'] == [7, 5] and header['dtype'] == BASE.dtype.str and header['compression'] is None
+
+    # fields that are not given are still present
+    save_lattice((BASE[:, :, 0], 4, 3, 50), filename)
+    header = lattice_header(filename)
+    assert all(header[key] is None for key in ('bounds', 'maxiter', 'update_func', 'seed'))
+
+def test_created_lattice(tmp_path):
+
+    filename = str(tmp_path/'a.lattice')
+    mm = create_lattice(filename, (6, 4), width=2, height=1, dpi=3, fortran_order=True, maxiter=10)
+    mm[:] = BASE[:6, :4, 0]
+    mm.flush()
+    del mm
+
+    B, width, height, dpi = open_lattice(filename)
+
+    assert (width, height, dpi) == (2, 1, 3) and B.flags.f_contiguous
+    np.testing.assert_array_equal(B, BASE[:6, :4, 0])
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_truncated_file(tmp_path, compress):
+
+    filename = str(tmp_path/'a.lattice')
+    save_lattice((np.random.default_rng(0).random((40, 40)), 4, 3, 50), filename, compress=compress)
+
+    with open(filename, 'r+b') as f:
+        f.truncate(lattice_header(filename)['offset'] + 100)
+
+    with pytest.raises(ValueError):
+        open_lattice(filename)
+
+def test_not_a_lattice_file(tmp_path):
+
+    filename = tmp_path/'a.npz'
+    filename.write_bytes(b'PK\x03\x04' + bytes(60))
+
+    with pytest.raises(ValueError):
+        open_lattice(str(filename))
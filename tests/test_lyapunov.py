@@ -0,0 +1,15 @@
+import numpy as np
+from lyapunov import lyapunov
+
+XB = (2.60, 4.0)
+YB = (2.45, 4.0)
+
+def test_tol_stops_close_to_full_mean():
+
+    full = lyapunov('AAAABA', XB, YB, maxiter=1000, dpi=20)[0]
+    early = lyapunov('AAAABA', XB, YB, maxiter=1000, dpi=20, tol=1e-3)[0]
+    error = np.abs(early - full)
+
+    assert np.isfinite(early).all()
+    assert np.percentile(error, 99) < 0.01
+    assert error.max() < 0.05
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from random_walks import construct_moves, random_walk_3D
+
+MOVES = construct_moves(np.array([[1,0,0],[0,1,0],[0,0,1]]))
+WALK = dict(width=1, height=1, depth=2, dpi=50, walkers=4, seed=5)
+
+@pytest.mark.parametrize('tracking', ['visitation', 'temporal'])
+def test_walk_independent_of_workers(tracking):
+
+    expected = random_walk_3D(MOVES, 50000, tracking=tracking, workers=1, **WALK)[0]
+
+    for workers in (2, 3, 4):
+        np.testing.assert_array_equal(random_walk_3D(MOVES, 50000, tracking=tracking, workers=workers, **WALK)[0], expected)
+
+@pytest.mark.parametrize('tracking', ['visitation', 'temporal'])
+def test_dense_matches_sparse(tracking):
+
+    dense = random_walk_3D(MOVES, 50000, tracking=tracking, workers=2, **WALK)[0]
+    sparse = random_walk_3D(MOVES, 50000, tracking=tracking, workers=3, sparse=True, chunk=8, **WALK)[0]
+
+    np.testing.assert_array_equal(sparse.densify(), dense)
+
+@pytest.mark.parametrize('vert_exag', [0, 5.0])
+def test_sparse_image_matches_dense(tmp_path, vert_exag):
+
+    from PIL import Image
+    from image_creation import random_walk_3D_image
+
+    for sparse in (False, True):
+        walk = random_walk_3D(MOVES, 50000, workers=2, sparse=sparse, **WALK)
+        random_walk_3D_image(walk, filename=str(tmp_path/str(sparse)), vert_exag=vert_exag)
+
+    np.testing.assert_array_equal(np.asarray(Image.open(tmp_path/'True.png')), np.asarray(Image.open(tmp_path/'False.png')))
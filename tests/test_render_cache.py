@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from complex_dynamics import mandelbrot, power
+from render_cache import RenderCache
+
+VIEW = ((-2.2, 0.8), (-1.5, 1.5), power)
+
+@pytest.mark.parametrize('log_smooth', [False, True])
+def test_partial_hit_matches_direct_render(tmp_path, log_smooth):
+
+    cache = RenderCache(directory=str(tmp_path))
+    kw = dict(width=1, height=1, dpi=60, log_smooth=log_smooth)
+
+    cache.mandelbrot(*VIEW, maxiter=300, **kw)
+    lattice = cache.mandelbrot(*VIEW, maxiter=30, **kw)[0]
+
+    assert cache.stats['partial_hits'] == 1
+    np.testing.assert_array_equal(lattice, mandelbrot(*VIEW, maxiter=30, **kw)[0])
+
+def test_no_partial_hit_when_supersampled(tmp_path):
+
+    cache = RenderCache(directory=str(tmp_path))
+    kw = dict(width=1, height=1, dpi=60, antialias=3)
+
+    cache.mandelbrot(*VIEW, maxiter=300, **kw)
+    lattice = cache.mandelbrot(*VIEW, maxiter=30, **kw)[0]
+
+    assert cache.stats['partial_hits'] == 0
+    np.testing.assert_array_equal(lattice, mandelbrot(*VIEW, maxiter=30, **kw)[0])
@@ -0,0 +1,15 @@
+import os
+import tempfile
+import numpy as np
+import pytest
+from complex_dynamics import mandelbrot, power
+from tiled import render_tiled
+
+@pytest.mark.skipif(os.name != 'posix', reason='the temporary lattice is only unlinked on POSIX')
+def test_temporary_lattice_is_removed(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    lattice = render_tiled((-2.0, 1.0), (-1.5, 1.5), power, width=1, height=1, dpi=40, maxiter=50, tile=16)[0]
+
+    assert os.listdir(tmp_path) == []
+    np.testing.assert_array_equal(lattice, mandelbrot((-2.0, 1.0), (-1.5, 1.5), power, width=1, height=1, dpi=40, maxiter=50)[0])
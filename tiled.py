@@ -0,0 +1,95 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from matplotlib import pyplot as plt
+from grid import grid
+from kernel_cache import specialize, get_num_threads
+from complex_dynamics import ESCAPE_KERNELS
+from image_creation import colorize, write_png
+from lattice_io import create_lattice, open_lattice
+
+# tiled rendering for output too large to hold in memory, the lattice lives in a memory-mapped lattice file (stored
+# in Fortran order, one image row after another, so that the image can be written a row at a time) and is computed
+# one fixed-size tile at a time
+
+def _tiles(nx, ny, tile):
+
+    return [(i0, min(i0 + tile, nx), j0, min(j0 + tile, ny)) for i0 in range(0, nx, tile) for j0 in range(0, ny, tile)]
+
+def _render_tile(job):
+
+    path, (i0, i1, j0, j1), xvals, yvals, c, update_func, args, maxiter, horizon, log_smooth = job
+    kernels = specialize(update_func, ESCAPE_KERNELS)
+
+    if c is None:
+        A = kernels._mandelbrot_kernel(xvals, yvals, args, maxiter, horizon, log_smooth, 0.0, False)[0]
+    else:
+        A = kernels._julia_kernel(c, xvals, yvals, args, maxiter, horizon, log_smooth, 0.0)[0]
+
+    mm = open_lattice(path, mmap_mode='r+')[0]
+    mm[i0:i1, j0:j1] = A
+    mm.flush()
+
+    return A.min(), A.max()
+
+def _png_blocks(mm, cmap, gamma, vmin, vmax, rows):
+
+    ny = mm.shape[1]
+
+    for r0 in range(0, ny, rows):
+        r1 = min(r0 + rows, ny)
+        yield colorize(mm[:, ny - r1:ny - r0].T[::-1], cmap=cmap, gamma=gamma, vmin=vmin, vmax=vmax)
+
+def render_tiled(xbound, ybound, update_func, c=None, args=2, width=5, height=5, dpi=100, maxiter=100, horizon=2.0**40, log_smooth=True,
+                 tile=1024, lattice_file=None, workers=None, backend='threads', filename=None, cmap=plt.cm.hot, gamma=0.3, rows=256):
+
+    """
+        computes a Mandelbrot (or Julia, if c is given) array tile by tile into a memory-mapped lattice_file (see
+        lattice_io, a temporary file by default), so peak memory is bounded by the tile size regardless of the output resolution,
+        on POSIX systems the temporary file is unlinked once mapped (its space is freed with the returned memmap), elsewhere
+        it is left for the caller to delete (lattice.filename)
+
+        with backend='threads' the tiles are computed in turn by the parallel kernel, with backend='processes' they are
+        spread over a pool of workers that write into the memmap directly, if filename is given the image is colored
+        (as image does with vert_exag=0) and written to filename.png rows at a time, returns (lattice, width, height, dpi)
+        where lattice is the (nx, ny) memmap
+    """
+
+    xvals, yvals = grid(xbound, ybound, width=width, height=height, dpi=dpi)
+    nx, ny = len(xvals), len(yvals)
+    c = None if c is None else complex(c)
+
+    temporary = lattice_file is None
+
+    if temporary:
+        fd, lattice_file = tempfile.mkstemp(suffix='.lattice')
+        os.close(fd)
+
+    mm = create_lattice(lattice_file, (nx, ny), width=width, height=height, dpi=dpi, fortran_order=True, bounds=[xbound, ybound], maxiter=maxiter,
+                        update_func=update_func, c=c)
+    del mm
+
+    jobs = [(lattice_file, t, xvals[t[0]:t[1]], yvals[t[2]:t[3]], c, update_func, args, maxiter, horizon, log_smooth) for t in _tiles(nx, ny, tile)]
+
+    if backend == 'threads':
+        bounds = [_render_tile(job) for job in jobs]
+    elif backend == 'processes':
+        workers = get_num_threads() if workers is None else int(workers)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+            bounds = list(pool.map(_render_tile, jobs))
+    else:
+        raise ValueError('backend must be threads or processes')
+
+    mm = open_lattice(lattice_file, mmap_mode='r+')[0]
+
+    # the open memmap keeps an unlinked file's data until it is released
+    if temporary and os.name == 'posix':
+        os.remove(lattice_file)
+
+    if filename is not None:
+        vmin = min(b[0] for b in bounds)
+        vmax = max(b[1] for b in bounds)
+        write_png(filename + '.png', _png_blocks(mm, cmap, gamma, vmin, vmax, rows), nx, ny)
+
+    return (mm, width, height, dpi)